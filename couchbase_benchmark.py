@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for couchbase_exporter.py against recorded fixture payloads.
+__Usage:__ couchbase_benchmark.py collect|decode|scrape|serve [-b buckets] [-n nodes] [--samples samples] [-s scrapes] [--exporter path]
+"""
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import argparse, importlib.util, io, json, multiprocessing, os, resource, subprocess, sys, time, tracemalloc
+import requests
+
+BASE_URL = 'http://fixture:8091'
+
+"""
+Import couchbase_exporter from path, e.g. an older revision extracted with
+git show <rev>:couchbase_exporter.py to compare against
+"""
+def load_exporter(path):
+    if path is None:
+        import couchbase_exporter
+        return couchbase_exporter
+    spec = importlib.util.spec_from_file_location('couchbase_exporter_under_test', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+"""
+Per-scrape CPU time of CouchbaseCollector.collect with the http layer
+replaced by a lookup in the fixture payloads, so only the exporter's own
+extraction and GaugeMetricFamily building is measured
+"""
+def bench_collect(args):
+    from couchbase_fixtures import build_payloads
+    exporter = load_exporter(args.exporter)
+    payloads = build_payloads(args.buckets, args.nodes)
+    collector = exporter.CouchbaseCollector(BASE_URL, exporter.get_metrics())
+    collector._request_data = lambda url, wanted=None: payloads[urlparse(url).path]
+
+    series = sum(len(family.samples) for family in collector.collect())
+    start_cpu, start = time.process_time(), time.time()
+    for _ in range(args.scrapes):
+        for family in collector.collect():
+            pass
+    cpu, wall = time.process_time() - start_cpu, time.time() - start
+    print('buckets: {0} nodes: {1} series: {2}'.format(args.buckets, args.nodes, series))
+    print('cpu per scrape: {0:.2f} ms, wall per scrape: {1:.2f} ms'.format(1000 * cpu / args.scrapes, 1000 * wall / args.scrapes))
+
+"""
+Decode time and peak memory of each available decoder on the serialized
+bucket list, bucket stats and XDCR stats payloads
+"""
+def bench_decode(args):
+    from couchbase_fixtures import build_payloads
+    exporter = load_exporter(args.exporter)
+    payloads = build_payloads(args.buckets, args.nodes, samples=args.samples)
+    wanted = [group.stats_ids for group in exporter.compile_metrics(exporter.get_metrics(), '') if group.key == 'buckets'][0]
+    documents = [
+        ('buckets', '/pools/default/buckets/'),
+        ('bucket_stats', '/pools/default/buckets/bucket0/stats'),
+        ('bucket_xdcr_stats', '/pools/default/buckets/@xdcr-bucket0/stats'),
+    ]
+    decoders = [('json', lambda body, stats: json.loads(body))]
+    if exporter.json_loads is not json.loads:
+        decoders.append((exporter.json_loads.__module__, lambda body, stats: exporter.json_loads(body)))
+    if exporter.ijson is not None:
+        decoders.append(('ijson select', lambda body, stats: exporter.select_samples(io.BytesIO(body), wanted) if stats else None))
+
+    for document, path in documents:
+        body = json.dumps(payloads[path]).encode('utf-8')
+        print('{0}: {1} KB'.format(document, len(body) // 1024))
+        for name, decode in decoders:
+            if decode(body, document == 'bucket_stats') is None:
+                continue
+            start = time.process_time()
+            for _ in range(args.scrapes):
+                decode(body, document == 'bucket_stats')
+            cpu = (time.process_time() - start) / args.scrapes
+            tracemalloc.start()
+            decode(body, document == 'bucket_stats')
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('  {0:<14} {1:8.2f} ms {2:10.1f} KB peak'.format(name, 1000 * cpu, peak / 1024.0))
+
+"""
+Start couchbase_mock_server.py in a separate process, so its payloads do
+not count towards the exporter's memory, and wait until it answers
+"""
+def start_mock_server(args):
+    from couchbase_mock_server import free_port
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'couchbase_mock_server.py')
+    process = subprocess.Popen([sys.executable, script, '-p', str(port), '-b', str(args.buckets), '-n', str(args.nodes),
+        '--samples', str(args.samples), '-l', str(args.latency)], stdout=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:%d' % port
+    for _ in range(100):
+        try:
+            requests.get(url + '/mock/stats', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('mock server did not start on port %d' % port)
+
+def mock_stats(url):
+    return requests.get(url + '/mock/stats').json()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+"""
+End to end scrapes of a mock couchbase (or --target) over http: scrapes/sec,
+p50/p99 scrape duration, bytes transferred per scrape and peak RSS
+"""
+def bench_scrape(args):
+    exporter = load_exporter(args.exporter)
+    process, url = (None, args.target) if args.target else start_mock_server(args)
+    try:
+        options = {}
+        if args.workers != 1:
+            options['workers'] = args.workers
+        if args.decoder:
+            options['decoder'] = args.decoder
+        if args.stats_since_last:
+            options['stats_since_last'] = True
+        if args.topology_ttl:
+            options['topology_ttl'] = args.topology_ttl
+        if args.per_node_stats:
+            options['per_node_stats'] = True
+            options['aggregate_nodes'] = True
+        if args.group_interval:
+            options['group_intervals'] = exporter.parse_group_intervals(args.group_interval)
+        metrics = exporter.get_metrics()
+        if args.metrics_config:
+            metrics, options['bucket_patterns'] = exporter.load_catalogue(args.metrics_config)
+        collector = exporter.CouchbaseCollector(url, metrics, **options)
+        list(collector.collect())
+        before = mock_stats(url) if process else None
+
+        durations = []
+        start_cpu, start = time.process_time(), time.time()
+        for _ in range(args.scrapes):
+            scrape_start = time.time()
+            series = sum(len(family.samples) for family in collector.collect())
+            durations.append(time.time() - scrape_start)
+        cpu, wall = time.process_time() - start_cpu, time.time() - start
+
+        print('target: {0} series: {1} workers: {2}'.format(args.target or 'mock, buckets: {0} nodes: {1} latency: {2} ms'.format(
+            args.buckets, args.nodes, args.latency), series, args.workers))
+        print('scrapes/sec: {0:.2f}'.format(args.scrapes / wall))
+        print('scrape duration p50: {0:.1f} ms p99: {1:.1f} ms'.format(1000 * percentile(durations, 0.5), 1000 * percentile(durations, 0.99)))
+        print('cpu per scrape: {0:.1f} ms'.format(1000 * cpu / args.scrapes))
+        if process:
+            after = mock_stats(url)
+            print('requests per scrape: {0:.1f} bytes per scrape: {1:.0f} KB'.format(
+                (after['requests'] - before['requests']) / float(args.scrapes), (after['bytes'] - before['bytes']) / 1024.0 / args.scrapes))
+            print('requests per scrape by node: {0}'.format(', '.join('{0} {1:.1f}'.format(host, (count - before['hosts'].get(host, 0)) / float(args.scrapes))
+                for host, count in sorted(after['hosts'].items()))))
+        print('peak rss: {0:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    finally:
+        if process:
+            process.kill()
+            process.wait()
+
+"""
+Child process of bench_serve: a snapshot of the fixture payloads served
+by server on port, answering every message on conn with its CPU time
+"""
+def serve_snapshot(args, server, port, conn):
+    from couchbase_fixtures import build_payloads
+    from prometheus_client import start_http_server
+    from prometheus_client.core import REGISTRY
+    exporter = load_exporter(args.exporter)
+    payloads = build_payloads(args.buckets, args.nodes)
+    collector = exporter.CouchbaseCollector(BASE_URL, exporter.get_metrics(), refresh_interval=60)
+    collector._request_data = lambda url, wanted=None: payloads[urlparse(url).path]
+    collector.refresh()
+    REGISTRY.register(collector)
+    if server == 'async':
+        exposition = exporter.ExpositionServer(REGISTRY)
+        exposition.render()
+        exposition.serve(port)
+    else:
+        start_http_server(port)
+    conn.send(None)
+    while True:
+        conn.recv()
+        conn.send(time.process_time())
+
+"""
+Requests/sec, latency and server CPU per request of /metrics served by
+prometheus_client's start_http_server and by the pre-rendered async
+server, with args.concurrency keep-alive clients
+"""
+def bench_serve(args):
+    from couchbase_mock_server import free_port
+    headers = {'Accept-Encoding': 'gzip' if args.gzip else 'identity'}
+    for server in ('prometheus', 'async'):
+        port = free_port()
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve_snapshot, args=(args, server, port, child_conn))
+        process.start()
+        try:
+            conn.recv()
+            url = 'http://127.0.0.1:%d/metrics' % port
+            sessions = [requests.Session() for _ in range(args.concurrency)]
+            size = len(sessions[0].get(url, headers=headers, stream=True).raw.read())
+
+            def client(session):
+                durations = []
+                for _ in range(args.scrapes):
+                    start = time.time()
+                    session.get(url, headers=headers).content
+                    durations.append(time.time() - start)
+                return durations
+
+            conn.send(None)
+            start_cpu, start = conn.recv(), time.time()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                durations = sum(executor.map(client, sessions), [])
+            wall = time.time() - start
+            conn.send(None)
+            cpu = conn.recv() - start_cpu
+            print('{0}: response {1} KB{2}'.format(server, size // 1024, ' gzip' if args.gzip else ''))
+            print('  requests/sec: {0:.1f} latency p50: {1:.2f} ms p99: {2:.2f} ms'.format(
+                len(durations) / wall, 1000 * percentile(durations, 0.5), 1000 * percentile(durations, 0.99)))
+            print('  server cpu per request: {0:.2f} ms'.format(1000 * cpu / len(durations)))
+        finally:
+            process.kill()
+            process.join()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='couchbase exporter benchmarks'
+    )
+    parser.add_argument('benchmark', choices=['collect', 'decode', 'scrape', 'serve'], help='benchmark to run')
+    parser.add_argument('-b', '--buckets', type=int, default=40, help='buckets in the fixture')
+    parser.add_argument('-n', '--nodes', type=int, default=3, help='nodes in the fixture')
+    parser.add_argument('--samples', type=int, default=60, help='samples per stat in the fixture')
+    parser.add_argument('-s', '--scrapes', type=int, default=50, help='scrapes to measure')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='scrape: milliseconds the mock server adds to every request')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='scrape: concurrent requests of the exporter')
+    parser.add_argument('--decoder', default=None, help='scrape: --decoder of the exporter')
+    parser.add_argument('--stats-since-last', action='store_true', help='scrape: --stats-since-last of the exporter')
+    parser.add_argument('--topology-ttl', type=float, default=0, help='scrape: --topology-ttl of the exporter')
+    parser.add_argument('--per-node-stats', action='store_true', help='scrape: --per-node-stats --aggregate-nodes of the exporter')
+    parser.add_argument('--group-interval', action='append', default=None, help='scrape: --group-interval of the exporter')
+    parser.add_argument('--metrics-config', default=None, help='scrape: --metrics-config of the exporter')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='serve: concurrent keep-alive scrapers, each sending --scrapes requests')
+    parser.add_argument('--gzip', action='store_true', help='serve: request gzip responses')
+    parser.add_argument('--target', default=None, help='scrape: couchbase url to scrape instead of the mock server')
+    parser.add_argument('--exporter', default=None, help='path of the couchbase_exporter.py to benchmark')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    {'collect': bench_collect, 'decode': bench_decode, 'scrape': bench_scrape, 'serve': bench_serve}[args.benchmark](args)
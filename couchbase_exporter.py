@@ -1,118 +1,1379 @@
 #!/usr/bin/env python
 
-from prometheus_client import start_http_server
-from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+from prometheus_client import start_http_server, generate_latest
+from prometheus_client.openmetrics.exposition import generate_latest as generate_openmetrics
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily, SummaryMetricFamily, REGISTRY
+from prometheus_client.utils import floatToGoString
 from functools import reduce
 from operator import getitem
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-import json, requests, sys, time, os, ast, signal, re, argparse
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from urllib.parse import urlparse, parse_qs
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json, requests, time, os, ast, signal, re, argparse, threading, copy, cProfile, marshal, pstats, asyncio, zlib
+
+# Optional faster JSON backends, the json module is used when missing
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Only needed for YAML metric catalogues
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+class CouchbaseRequestError(Exception):
+    pass
+
+"""
+Compiled form of one get_metrics entry: sanitized name, full family name,
+pre-split path into the couchbase document, label names, value suffix, the
+refresh group it belongs to and how per node values combine, see
+node_aggregation
+"""
+MetricSpec = namedtuple('MetricSpec', ['id', 'name', 'family', 'path', 'labels', 'suffix', 'group', 'node_aggregation'])
+
+"""
+Compiled form of one get_metrics group, each metric list a tuple of MetricSpec
+"""
+GroupPlan = namedtuple('GroupPlan', ['key', 'url', 'metrics', 'bucket_stats', 'bucket_xdcr_stats', 'stats_ids', 'node_stats'])
+
+"""
+Cached cluster topology: the signature it was built for, (name, stats uri)
+of every bucket, node hostnames and when the bucket list was fetched
+"""
+Topology = namedtuple('Topology', ['signature', 'buckets', 'nodes', 'fetched_at'])
+
+# The vBucket map is most of the bucket list document and never read
+GROUP_QUERIES = {'buckets': '?skipMap=true'}
+
+FAMILY_NAMES = {'cluster': 'cluster', 'nodes': 'node', 'buckets': 'bucket', 'bucket_stats': 'bucket_stats', 'bucket_xdcr_stats': 'bucket_xdcr_stats', 'node_stats': 'bucket_node_stats'}
+# Top level groups of get_metrics, each requested from its own url
+METRIC_GROUPS = ('cluster', 'nodes', 'buckets')
+# Keys every metric entry of get_metrics needs
+METRIC_KEYS = ('id', 'suffix', 'labels')
+OP_SAMPLES = ('op', 'samples')
+# Labels of every XDCR series, after the labels of the catalogue entry
+XDCR_LABELS = ('remote_cluster', 'target_bucket')
+
+# Groups of get_metrics that can each be refreshed on their own interval
+REFRESH_GROUPS = ('cluster', 'nodes', 'buckets', 'bucket_stats', 'bucket_xdcr_stats')
+
+# Pattern lists of the include and exclude sections of a metric catalogue
+CATALOGUE_PATTERNS = ('groups', 'metrics', 'buckets')
+
+# Scrape phases timed per refresh group, and their histogram buckets
+PHASES = ('fetch', 'decode', 'extract', 'build')
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+"""
+Reduce a list of stat samples, oldest first, to one value
+"""
+AGGREGATIONS = {
+    'avg': lambda samples: sum(samples) / float(len(samples)),
+    'max': max,
+    'last': lambda samples: samples[-1],
+}
+
+"""
+Combine the values of one bucket stat on every node into the cluster value,
+none leaves the stat out of the cluster level series
+"""
+NODE_AGGREGATIONS = {
+    'sum': sum,
+    'avg': AGGREGATIONS['avg'],
+    'max': max,
+    'none': None,
+}
+
+"""
+Node aggregation of a catalogue entry: its node_aggregation when given,
+else averages, ratios, rates and percentages are averaged, the sample
+timestamp is left out and counters and sizes are summed
+"""
+def node_aggregation(metric):
+    if 'node_aggregation' in metric:
+        return metric['node_aggregation']
+    stat_id = metric['id']
+    if stat_id == 'timestamp':
+        return 'none'
+    if stat_id.startswith('avg_') or '_avg_' in stat_id or stat_id.endswith(('_ratio', '_rate')) or metric['suffix'] == 'percent':
+        return 'avg'
+    return 'sum'
+
+"""
+Whether name matches one of the include glob patterns, or there are none,
+and none of the exclude patterns
+"""
+def matches_patterns(name, include, exclude):
+    if include and not any(fnmatchcase(name, pattern) for pattern in include):
+        return False
+    return not any(fnmatchcase(name, pattern) for pattern in exclude)
+
+"""
+Keep the groups and metric ids selected by the (include, exclude) patterns
+of a catalogue, dropping groups left without metrics so their endpoints
+are never requested
+"""
+def select_metrics(metrics, groups, metric_ids):
+    selected = {}
+    for key, values in metrics.items():
+        entry = dict(values)
+        for name, group in (('metrics', key), ('bucket_stats', 'bucket_stats'), ('bucket_xdcr_stats', 'bucket_xdcr_stats')):
+            if name in entry:
+                entry[name] = [metric for metric in entry[name] if matches_patterns(group, *groups) and matches_patterns(metric['id'], *metric_ids)]
+        if any(entry.get(name) for name in ('metrics', 'bucket_stats', 'bucket_xdcr_stats')):
+            selected[key] = entry
+    return selected
+
+"""
+Load a metric catalogue from a YAML or JSON file: metrics, shaped like
+get_metrics and defaulting to it, and include/exclude glob patterns for
+groups, metric ids and buckets. Returns the selected metrics and the
+(include, exclude) bucket patterns. Raises ValueError for a catalogue
+that does not compile
+"""
+def load_catalogue(path):
+    with open(path) as f:
+        text = f.read()
+    if path.endswith('.json'):
+        config = json.loads(text)
+    elif yaml is None:
+        raise ValueError('PyYAML is not installed, use a .json metric catalogue')
+    else:
+        config = yaml.safe_load(text)
+    config = config or {}
+    patterns = {}
+    for kind in ('include', 'exclude'):
+        entries = config.get(kind) or {}
+        unknown = set(entries) - set(CATALOGUE_PATTERNS)
+        if unknown:
+            raise ValueError('unknown {0} keys {1}, expected {2}'.format(kind, ', '.join(sorted(unknown)), ', '.join(CATALOGUE_PATTERNS)))
+        patterns[kind] = dict((key, tuple(entries.get(key) or ())) for key in CATALOGUE_PATTERNS)
+    selection = dict((key, (patterns['include'][key], patterns['exclude'][key])) for key in CATALOGUE_PATTERNS)
+    metrics = config.get('metrics') or get_metrics()
+    try:
+        compile_metrics(metrics, '')
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError('malformed metrics: {0!r}'.format(e))
+    metrics = select_metrics(metrics, selection['groups'], selection['metrics'])
+    return metrics, selection['buckets']
+
+"""
+Compile get_metrics into an immutable plan once at startup, so a scrape
+only does lookups and appends. Raises ValueError for unknown groups and
+node aggregations, and entries missing a key
+"""
+def compile_metrics(metrics, prefix, extra_labels=()):
+    def compile_list(family, group, entries, list_labels=()):
+        specs = []
+        fixed_labels = tuple(list_labels) + tuple(extra_labels)
+        for index, metric in enumerate(entries):
+            missing = [key for key in METRIC_KEYS if key not in metric]
+            if missing:
+                raise ValueError('{0} metric {1} has no {2}'.format(group, metric.get('id', index), ', '.join(missing)))
+            if node_aggregation(metric) not in NODE_AGGREGATIONS:
+                raise ValueError('{0} metric {1} has unknown node_aggregation {2}, expected one of {3}'.format(
+                    group, metric['id'], metric['node_aggregation'], ', '.join(NODE_AGGREGATIONS)))
+            name = re.sub('(\\.)', '_', metric['id']).lower()
+            name = re.sub('(\\+)', '_plus_', name)
+            # Fixed labels are always appended, also when a catalogue lists them
+            labels = tuple(label for label in metric['labels'] if label not in fixed_labels)
+            specs.append(MetricSpec(metric['id'], name, '%s%s_%s' % (prefix, family, name), tuple(metric['id'].split('.')),
+                labels + fixed_labels, metric['suffix'], group, NODE_AGGREGATIONS[node_aggregation(metric)]))
+        return tuple(specs)
+
+    plan = []
+    for key, values in metrics.items():
+        if key not in METRIC_GROUPS:
+            raise ValueError('unknown metric group {0}, expected one of {1}'.format(key, ', '.join(METRIC_GROUPS)))
+        if 'url' not in values:
+            raise ValueError('metric group {0} has no url'.format(key))
+        plan.append(GroupPlan(key, values['url'],
+            compile_list(FAMILY_NAMES[key], key, values.get('metrics', [])),
+            compile_list(FAMILY_NAMES['bucket_stats'], 'bucket_stats', values.get('bucket_stats', [])),
+            compile_list(FAMILY_NAMES['bucket_xdcr_stats'], 'bucket_xdcr_stats', values.get('bucket_xdcr_stats', []), XDCR_LABELS),
+            frozenset([metric['id'] for metric in values.get('bucket_stats', [])] + ['timestamp']),
+            compile_list(FAMILY_NAMES['node_stats'], 'bucket_stats', values.get('bucket_stats', []), ('node',))))
+    return tuple(plan)
+
+"""
+Decode only op.samples.<id> for the wanted stat ids from a bucket stats
+stream, without building the stats that are not in the plan
+"""
+def select_samples(stream, wanted):
+    prefixes = dict(('op.samples.%s.item' % stat_id, stat_id) for stat_id in wanted)
+    samples = {}
+    for prefix, event, value in ijson.parse(stream, buf_size=16384, use_float=True):
+        stat_id = prefixes.get(prefix)
+        if stat_id is not None:
+            samples.setdefault(stat_id, []).append(value)
+    return {'op': {'samples': samples}}
+
+"""
+Decoders for a couchbase response. json reads the whole body with the
+fastest available backend, stream selects the planned bucket stats
+while reading and falls back to json for other documents
+"""
+def decode_json(response, wanted):
+    return json_loads(response.content)
+
+def decode_stream(response, wanted):
+    if wanted is None:
+        return decode_json(response, wanted)
+    response.raw.decode_content = True
+    return select_samples(response.raw, wanted)
+
+DECODERS = {
+    'json': decode_json,
+    'stream': decode_stream,
+}
+
+"""
+HTTPAdapter counting every connection its pools open. The count keeps
+growing when the pool manager evicts the pool of a host
+"""
+class CountingAdapter(HTTPAdapter):
+
+    def __init__(self, *args, **kwargs):
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+        super(CountingAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingAdapter, self).init_poolmanager(*args, **kwargs)
+        pool_classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = dict((scheme, self._counting_pool(pool_class)) for scheme, pool_class in pool_classes.items())
+
+    """
+    Subclass of pool_class adding to connections for every new connection
+    """
+    def _counting_pool(self, pool_class):
+        adapter = self
+        def _new_conn(pool):
+            with adapter.connections_lock:
+                adapter.connections += 1
+            return pool_class._new_conn(pool)
+        return type('Counting' + pool_class.__name__, (pool_class,), {'_new_conn': _new_conn})
 
 class CouchbaseCollector(object):
     METRIC_PREFIX = 'couchbase_'
+    # Hosts with their own keep-alive pool, every node when stats are fetched per node
+    POOL_HOSTS = 64
     #metrics = get_metrics()
     gauges = {}
 
-    def __init__(self, target, metrics):
+    def __init__(self, target, metrics, workers=1, connect_timeout=5.0, read_timeout=30.0, retries=2, retry_backoff=0.5, pool_size=None, refresh_interval=0, cluster=None, stats_aggregation='avg', stats_since_last=False, decoder='json', topology_ttl=0, per_node_stats=False, aggregate_nodes=False, group_intervals=None, bucket_patterns=None):
         self.BASE_URL = target.rstrip("/")
+        self.cluster = cluster
         self.metrics = metrics
+        self.cluster_labels, self.cluster_values = self._cluster_labels()
+        self.plan = compile_metrics(metrics, self.METRIC_PREFIX, self.cluster_labels)
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = self._create_session(pool_size or self.workers, retries, retry_backoff)
+        self.request_lock = threading.Lock()
+        self.request_count = 0
+        self.request_seconds = 0.0
+        self.errors = {}
+        self.durations = {}
+        self.failures = 0
+        self.failed_groups = set()
+        self.refresh_interval = refresh_interval
+        self.snapshot = None
+        self.aggregate = AGGREGATIONS[stats_aggregation]
+        self.stats_since_last = stats_since_last
+        self.stats_tstamps = {}
+        self.stats_samples = {}
+        if decoder == 'stream' and ijson is None:
+            print('ijson is not installed, decoding whole documents instead of streaming')
+            decoder = 'json'
+        self.decoder = decoder
+        self.decode = DECODERS[decoder]
+        self.topology_ttl = topology_ttl
+        if topology_ttl and self.workers == 1:
+            print('--topology-ttl only overlaps bucket stats requests with the bucket list request with --workers > 1')
+        self.topology = None
+        self.topology_hits = 0
+        self.topology_misses = 0
+        self.prefetched = None
+        self.per_node_stats = per_node_stats
+        self.aggregate_nodes = aggregate_nodes
+        self.node_urls = {}
+        self.group_intervals = group_intervals or {}
+        self.family_groups = self._family_groups()
+        self.groups = self._plan_groups()
+        self.group_cache = {}
+        self.due = frozenset(REFRESH_GROUPS)
+        self.bucket_patterns = bucket_patterns or ((), ())
+        self.pending_catalogue = None
+        self.phase_seconds = {}
+        self.phase_histograms = {}
+        self.profile_capture = None
+
+    """
+    Refresh group of every metric family in the plan
+    """
+    def _family_groups(self):
+        groups = {}
+        for group in self.plan:
+            for spec in group.metrics + group.bucket_stats + group.node_stats + group.bucket_xdcr_stats:
+                groups[spec.family] = spec.group
+        return groups
+
+    """
+    Refresh groups with at least one metric in the plan, the others are
+    never due and their endpoints never requested
+    """
+    def _plan_groups(self):
+        groups = set()
+        for group in self.plan:
+            if group.metrics:
+                groups.add(group.key)
+            if group.bucket_stats:
+                groups.add('bucket_stats')
+            if group.bucket_xdcr_stats:
+                groups.add('bucket_xdcr_stats')
+        return frozenset(groups)
 
     """
-    Split dots in metric name and search for it in obj dict
+    Replace the metrics and bucket patterns at the start of the next scrape,
+    e.g. after the catalogue was reloaded on SIGHUP
     """
-    def _dot_get(self, metric, obj):
+    def reload(self, metrics, bucket_patterns):
+        self.pending_catalogue = (metrics, bucket_patterns)
+
+    """
+    Compile a reloaded catalogue and drop everything cached for the old one.
+    Nothing is replaced when it does not compile
+    """
+    def _apply_catalogue(self, metrics, bucket_patterns):
+        plan = compile_metrics(metrics, self.METRIC_PREFIX, self.cluster_labels)
+        self.metrics = metrics
+        self.bucket_patterns = bucket_patterns
+        self.plan = plan
+        self.family_groups = self._family_groups()
+        self.groups = self._plan_groups()
+        self.group_cache = {}
+        self.topology = None
+        self.stats_tstamps = {}
+        self.stats_samples = {}
+
+    """
+    Create the keep-alive session shared by every request of this collector.
+    Auth username and password can be defined as environment variables
+    """
+    def _create_session(self, pool_size, retries, retry_backoff):
+        session = requests.Session()
+        if set(["COUCHBASE_USERNAME","COUCHBASE_PASSWORD"]).issubset(os.environ):
+            session.auth = HTTPBasicAuth(os.environ["COUCHBASE_USERNAME"], os.environ["COUCHBASE_PASSWORD"])
+        retry = Retry(total=retries, backoff_factor=retry_backoff, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+        adapter = CountingAdapter(pool_connections=max(pool_size, self.POOL_HOSTS), pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    """
+    Extra label names and values identifying the cluster in multi-target mode
+    """
+    def _cluster_labels(self):
+        if self.cluster is None:
+            return (), ()
+        return ('cluster',), (self.cluster,)
+
+    """
+    Number of connections (TCP/TLS handshakes) opened by the session so far
+    """
+    def _connection_count(self):
+        return sum(adapter.connections for adapter in set(self.session.adapters.values()))
+
+    """
+    Search the pre-split metric path in obj dict
+    """
+    def _dot_get(self, path, obj):
         try:
-            return reduce(getitem, metric.split('.'), obj)
+            return reduce(getitem, path, obj)
         except Exception as e:
             return False
 
     """
-    Request data via CURL with or without authentication.
-    Auth username and password can be defined as environment variables
+    Request data through the shared session, retrying failed connections
+    and 5xx responses with backoff. wanted is the set of bucket stats ids
+    a streaming decoder may restrict the document to.
     :rtype JSON
     """
-    def _request_data(self, url):
+    def _request_data(self, url, wanted=None):
+        start = time.time()
+        stream = self.decoder == 'stream' and wanted is not None
         try:
-            if set(["COUCHBASE_USERNAME","COUCHBASE_PASSWORD"]).issubset(os.environ):
-                response = requests.get(url, auth=HTTPBasicAuth(os.environ["COUCHBASE_USERNAME"], os.environ["COUCHBASE_PASSWORD"]))
-            else:
-                response = requests.get(url)
+            response = self.session.get(url, timeout=self.timeout, stream=stream)
         except Exception as e:
-            print('Failed to establish a new connection. Is {0} correct?'.format(self.BASE_URL))
-            sys.exit(1)
-
-        if response.status_code != requests.codes.ok:
-            print('Response Status ({0}): {1}'.format(response.status_code, response.text))
-            sys.exit(1)
+            raise CouchbaseRequestError('Failed to establish a new connection. Is {0} correct? {1}'.format(self.BASE_URL, e))
 
-        result = response.json()
+        fetched = time.time()
+        try:
+            if response.status_code != requests.codes.ok:
+                raise CouchbaseRequestError('Response Status ({0}): {1}'.format(response.status_code, response.text))
+            result = self.decode(response, wanted)
+        except CouchbaseRequestError:
+            raise
+        except Exception as e:
+            raise CouchbaseRequestError('Invalid JSON from {0}: {1}'.format(url, e))
+        finally:
+            if stream:
+                response.raw.drain_conn()
+                response.raw.release_conn()
+        end = time.time()
+        group = self._endpoint_group(urlparse(url).path)
+        with self.request_lock:
+            self.request_count += 1
+            self.request_seconds += end - start
+            self._phase_time('fetch', group, fetched - start)
+            self._phase_time('decode', group, end - fetched)
         return result
 
     """
-    Add metrics in GaugeMetricFamily format
+    Refresh group an endpoint path is requested for
+    """
+    def _endpoint_group(self, endpoint):
+        if endpoint.endswith('/stats'):
+            return 'bucket_xdcr_stats' if '/@xdcr-' in endpoint else 'bucket_stats'
+        for group in self.plan:
+            if endpoint == group.url:
+                return group.key
+        return 'other'
+
+    """
+    Request data for one endpoint without recording anything, returns
+    (endpoint, seconds, data, error) for _record_request
+    """
+    def _timed_request(self, url, wanted=None):
+        endpoint = urlparse(url).path
+        start = time.time()
+        try:
+            data, error = self._request_data(url, wanted), None
+        except CouchbaseRequestError as e:
+            data, error = None, e
+        return endpoint, time.time() - start, data, error
+
+    """
+    Record the duration and error of a timed request and return its data.
+    A failed endpoint returns None so the rest of the scrape goes on, its
+    refresh group is marked failed
+    """
+    def _record_request(self, endpoint, seconds, data, error):
+        if error is not None:
+            print(error)
+            with self.request_lock:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                self.failures += 1
+                self.failed_groups.add(self._endpoint_group(endpoint))
+        self.durations[endpoint] = seconds
+        return data
+
+    """
+    Request data for one endpoint, recording its duration and errors
+    """
+    def _request_endpoint(self, url, wanted=None):
+        return self._record_request(*self._timed_request(url, wanted))
+
+    """
+    Request several urls, at most self.workers of them in flight at once.
+    Results are yielded in the same order as the urls, and released once
+    consumed so decoded documents do not pile up. Without record the timed
+    results are yielded for the caller to record
+    """
+    def _request_all(self, urls, wanted=None, record=True):
+        wanted = wanted or [None] * len(urls)
+        request = self._request_endpoint if record else self._timed_request
+        if self.executor is None:
+            return (request(url, ids) for url, ids in zip(urls, wanted))
+        capture = self.profile_capture
+        if capture is not None and capture.active:
+            request = capture.profiled(request)
+        return self.executor.map(request, urls, wanted)
+
+    """
+    Index XDCR samples by stat id in one pass. Keys look like
+    replications/<remote cluster uuid>/<source bucket>/<target bucket>/<stat>,
+    each becomes a (remote cluster, target bucket, samples) entry. Bucket
+    level keys are only used for stats without per replication keys
+    """
+    def _index_xdcr(self, samples):
+        index = {}
+        totals = {}
+        for key, values in samples.items():
+            parts = key.split('/')
+            if len(parts) == 5 and parts[0] == 'replications':
+                index.setdefault(parts[4], []).append((parts[1], parts[3], values))
+            elif len(parts) == 1:
+                totals[key] = values
+        for key, values in totals.items():
+            if key not in index:
+                index[key] = [('', '', values)]
+        return index
+
+    """
+    Stats url of a bucket, or of a (bucket, node) pair. With stats_since_last
+    only the samples newer than the last one already seen are requested
     """
-    def _add_metrics(self, metrics, metric_name, metric_gauges, data):
-        metric_id = re.sub('(\.)', '_', metrics['id']).lower()
-        metric_id = re.sub('(\+)', '_plus_', metric_id)          
-        metric_value = self._dot_get(metrics['id'], data)
-        gauges = [metric_id]
-        for gauge in metric_gauges:
-            gauges.append(gauge)
-        if metric_value is not False:
+    def _stats_url(self, key, url):
+        since = self.stats_tstamps.get(key)
+        if since is not None:
+            url += ('&' if '?' in url else '?') + 'zoom=minute&haveTStamp=%d' % since
+        return url
+
+    """
+    Samples of a bucket stats response. With stats_since_last the samples
+    of the previous scrape are kept when no newer ones were returned
+    """
+    def _bucket_samples(self, key, response):
+        samples = self._dot_get(OP_SAMPLES, response)
+        if not self.stats_since_last or response is None:
+            return samples
+        if samples and samples.get('timestamp'):
+            self.stats_tstamps[key] = samples['timestamp'][-1]
+            self.stats_samples[key] = samples
+        return self.stats_samples.get(key)
+
+    """
+    Drop the samples kept for stats_since_last of buckets, and nodes, that
+    are no longer listed
+    """
+    def _prune_stats(self, buckets, nodes):
+        names = set(name for name, stats_uri in buckets)
+        for key in list(self.stats_tstamps):
+            name, node = key if isinstance(key, tuple) else (key, None)
+            if name not in names or (node is not None and node not in nodes):
+                del self.stats_tstamps[key]
+                self.stats_samples.pop(key, None)
+
+    """
+    Nodes to request bucket stats from directly, empty when the stats are
+    requested cluster wide from BASE_URL
+    """
+    def _stats_nodes(self):
+        if not self.per_node_stats:
+            return ()
+        if self.nodes is not None:
+            return self.nodes
+        return self.topology.nodes if self.topology is not None else ()
+
+    """
+    Url of the node stats of a bucket, requested from the node itself
+    """
+    def _node_stats_url(self, group, name, node):
+        return '%s%s%s/nodes/%s/stats' % (self.node_urls.get(node) or self._node_url(node), group.url, name, node)
+
+    """
+    Base url of a node. hostname in /pools/nodes/ is the plain 8091 rest
+    port, over https the node's httpsMgmt port, or the port of BASE_URL,
+    is used instead
+    """
+    def _node_url(self, hostname, ports=None):
+        target = urlparse(self.BASE_URL)
+        if target.scheme != 'https':
+            return '%s://%s' % (target.scheme, hostname)
+        host = hostname.rpartition(':')[0] or hostname
+        return 'https://%s:%s' % (host, (ports or {}).get('httpsMgmt') or target.port or 18091)
+
+    """
+    Stats and XDCR stats urls of every (name, stats uri) bucket, with the
+    stats ids a streaming decoder should keep. With nodes the stats are
+    requested from every node instead of cluster wide
+    """
+    def _bucket_urls(self, group, buckets, nodes, stats=True, xdcr=True):
+        urls = []
+        wanted = []
+        for name, stats_uri in buckets:
+            if not stats:
+                pass
+            elif nodes:
+                for node in nodes:
+                    urls.append(self._stats_url((name, node), self._node_stats_url(group, name, node)))
+                    wanted.append(group.stats_ids)
+            else:
+                urls.append(self._stats_url(name, self.BASE_URL + stats_uri))
+                wanted.append(group.stats_ids)
+            if xdcr:
+                urls.append(self.BASE_URL + group.url + '@xdcr-' + name + '/stats')
+                wanted.append(None)
+        return urls, wanted
+
+    """
+    Signature of the topology in /pools/default/: the buckets uri carries a
+    version that changes whenever a bucket is added, removed or changed
+    """
+    def _topology_signature(self, cluster_data):
+        return self._dot_get(('buckets', 'uri'), cluster_data) or None
+
+    """
+    Cached topology while it is younger than topology_ttl, None when
+    caching is disabled or the topology has to be listed again
+    """
+    def _cached_topology(self):
+        if not self.topology_ttl or self.topology is None:
+            return None
+        if time.time() - self.topology.fetched_at >= self.topology_ttl:
+            return None
+        return self.topology
+
+    """
+    Add time spent in a scrape phase for a refresh group
+    """
+    def _phase_time(self, phase, group, seconds):
+        key = (phase, group)
+        self.phase_seconds[key] = self.phase_seconds.get(key, 0) + seconds
+
+    """
+    Add the time of every phase of this scrape to the phase histograms
+    """
+    def _observe_phases(self):
+        with self.request_lock:
+            for key, seconds in self.phase_seconds.items():
+                histogram = self.phase_histograms.setdefault(key, [[0] * (len(PHASE_BUCKETS) + 1), 0.0])
+                index = len([bound for bound in PHASE_BUCKETS if bound < seconds])
+                histogram[0][index] += 1
+                histogram[1] += seconds
+
+    """
+    Value of every spec in data, sample lists reduced to one value and
+    False where the metric is missing
+    """
+    def _extract_values(self, specs, data):
+        values = []
+        for spec in specs:
+            metric_value = self._dot_get(spec.path, data)
             if isinstance(metric_value, list):
-                metric_value = sum(metric_value) / float(len(metric_value))
-            if not metric_id in self.gauges:
-                self.gauges[metric_id] = GaugeMetricFamily('%s_%s' % (metric_name, metric_id), '%s' % metric_id, value=None, labels=metrics['labels'])
-            self.gauges[metric_id].add_metric(gauges, value=metric_value)
+                metric_value = self.aggregate(metric_value) if metric_value else False
+            values.append(metric_value)
+        return values
+
+    """
+    Add metrics in GaugeMetricFamily format, timing the extract and build
+    phases once for all specs. Returns the extracted values
+    """
+    def _add_metrics(self, specs, label_values, data):
+        if not specs:
+            return []
+        start = time.perf_counter()
+        values = self._extract_values(specs, data)
+        extracted = time.perf_counter()
+        for spec, metric_value in zip(specs, values):
+            if metric_value is not False:
+                self._add_value(spec, label_values, metric_value)
+        self._phase_time('extract', specs[0].group, extracted - start)
+        self._phase_time('build', specs[0].group, time.perf_counter() - extracted)
+        return values
+
+    """
+    Add one already computed value in GaugeMetricFamily format
+    """
+    def _add_value(self, spec, label_values, metric_value):
+        gauge = self.gauges.get(spec.family)
+        if gauge is None:
+            gauge = self.gauges[spec.family] = GaugeMetricFamily(spec.family, spec.name, value=None, labels=spec.labels)
+        gauge.add_metric((spec.name,) + label_values, value=metric_value)
+
+    """
+    Add the node stats of a bucket, one series per node, and with
+    aggregate_nodes the cluster level bucket stats, combined over the nodes
+    by the node aggregation of each stat. A stat missing on any node has
+    no cluster level series, rather than one that looks like a drop
+    """
+    def _add_node_stats(self, group, name, nodes, responses):
+        node_values = {}
+        for node in nodes:
+            samples = self._bucket_samples((name, node), next(responses))
+            if not samples:
+                continue
+            label_values = (name, node) + self.cluster_values
+            for index, value in enumerate(self._add_metrics(group.node_stats, label_values, samples)):
+                if value is not False:
+                    node_values.setdefault(index, []).append(value)
+        if self.aggregate_nodes:
+            start = time.perf_counter()
+            label_values = (name,) + self.cluster_values
+            for index, spec in enumerate(group.bucket_stats):
+                if len(node_values.get(index, ())) == len(nodes) and spec.node_aggregation is not None:
+                    self._add_value(spec, label_values, spec.node_aggregation(node_values[index]))
+            self._phase_time('build', 'bucket_stats', time.perf_counter() - start)
 
     """
     Collect cluster, nodes, bucket and bucket details metrics
     """
-    def _collect_metrics(self, key, values,uri_path, couchbase_data):
-        if key == 'cluster':
-            for metrics in values['metrics']:
-                self._add_metrics(metrics, self.METRIC_PREFIX + 'cluster', [], couchbase_data)
-        elif key == 'nodes':
+    def _collect_metrics(self, group, couchbase_data):
+        if group.key == 'buckets':
+            self._collect_buckets(group, couchbase_data)
+        elif couchbase_data is None:
+            return
+        elif group.key == 'cluster':
+            # A changed signature drops the cached topology for the next scrape
+            signature = self._topology_signature(couchbase_data)
+            if self.topology is not None and signature != self.topology.signature:
+                self.topology = None
+            self.signature = signature
+            self._add_metrics(group.metrics, self.cluster_values, couchbase_data)
+        elif group.key == 'nodes':
+            self.nodes = tuple(node['hostname'] for node in couchbase_data['nodes'])
+            self.node_urls = dict((node['hostname'], self._node_url(node['hostname'], node.get('ports'))) for node in couchbase_data['nodes'])
             for node in couchbase_data['nodes']:
-                for metrics in values['metrics']:
-                    self._add_metrics(metrics, self.METRIC_PREFIX + 'node', [node['hostname']], node)
-        elif key == 'buckets':
+                label_values = (node['hostname'],) + self.cluster_values
+                self._add_metrics(group.metrics, label_values, node)
+
+    """
+    Collect bucket metrics, and the detailed stats and replication stats of
+    every bucket when those groups are due. Without a fresh bucket list the
+    buckets of the last known topology are used
+    """
+    def _collect_buckets(self, group, couchbase_data):
+        stats, xdcr = 'bucket_stats' in self.due, 'bucket_xdcr_stats' in self.due
+        if couchbase_data is not None:
+            couchbase_data = [bucket for bucket in couchbase_data if matches_patterns(bucket['name'], *self.bucket_patterns)]
+            buckets = tuple((bucket['name'], bucket['stats']['uri']) for bucket in couchbase_data)
+        elif self.topology is not None:
+            buckets = self.topology.buckets
+        elif self.prefetched is not None:
+            buckets = self.prefetched[0][0]
+        else:
+            # Without a bucket list the due stats groups could not be requested
+            self.failed_groups.update(self.due & set(['bucket_stats', 'bucket_xdcr_stats']))
+            return
+        # Stats requests are already in flight when the cached topology
+        # still lists the same buckets
+        nodes = self._stats_nodes() if stats else ()
+        if couchbase_data is not None and stats:
+            self._prune_stats(buckets, nodes)
+        hit = self.prefetched is not None and self.prefetched[0] == (buckets, nodes, stats, xdcr)
+        if hit:
+            self.topology_hits += 1
+            responses = self.prefetched[1]
+        elif stats or xdcr:
+            if self.topology_ttl:
+                self.topology_misses += 1
+            responses = self._request_all(*self._bucket_urls(group, buckets, nodes, stats, xdcr))
+        self.prefetched = None
+        if couchbase_data is not None and (self.topology_ttl or self.group_intervals) and (not hit or self.topology is None):
+            known_nodes = self.nodes if self.nodes is not None else (self.topology.nodes if self.topology else ())
+            self.topology = Topology(self.signature, buckets, known_nodes, time.time())
+
+        if couchbase_data is not None and 'buckets' in self.due:
             for bucket in couchbase_data:
-                for metrics in values['metrics']:
-                    self._add_metrics(metrics, self.METRIC_PREFIX + 'bucket', [bucket['name']], bucket)
-               
-                # Get detailed stats for each bucket
-                bucket_stats = self._request_data(self.BASE_URL + bucket['stats']['uri'])
-                for bucket_metrics in values['bucket_stats']:
-                    self._add_metrics(bucket_metrics, self.METRIC_PREFIX + 'bucket_stats', [bucket['name']], bucket_stats["op"]["samples"])
-                
-                # Get detailed replication stats for each bucket                    
-                bucket_xdcr_stats = self._request_data(self.BASE_URL + uri_path + '@xdcr-' + bucket['name'] + '/stats' )
-                for bucket_xdcr_metrics in values['bucket_xdcr_stats']:
-                    match = [xm for xm in bucket_xdcr_stats['op']['samples'] if bucket_xdcr_metrics['id'] in xm]
-                    if len(match) > 0:
-                        data = {}
-                        match = match[0]
-                        data[bucket_xdcr_metrics['id']] = bucket_xdcr_stats['op']['samples'][match][0]
-                        self._add_metrics(bucket_xdcr_metrics, self.METRIC_PREFIX + 'bucket_xdcr_stats', [bucket['name']], data)
+                label_values = (bucket['name'],) + self.cluster_values
+                self._add_metrics(group.metrics, label_values, bucket)
+        if not (stats or xdcr):
+            return
+
+        for name, stats_uri in buckets:
+            label_values = (name,) + self.cluster_values
+            # Detailed stats for each bucket, cluster wide or from every node
+            if stats and nodes:
+                self._add_node_stats(group, name, nodes, responses)
+            elif stats:
+                bucket_stats = self._bucket_samples(name, next(responses))
+                if bucket_stats:
+                    self._add_metrics(group.bucket_stats, label_values, bucket_stats)
+
+            # Detailed replication stats for each bucket and replication
+            if xdcr:
+                response = next(responses)
+                start = time.perf_counter()
+                bucket_xdcr_stats = self._index_xdcr(self._dot_get(OP_SAMPLES, response) or {})
+                values = []
+                for spec in group.bucket_xdcr_stats:
+                    for remote_cluster, target_bucket, samples in bucket_xdcr_stats.get(spec.id, ()):
+                        data = {spec.id: samples}
+                        values.append((spec, (name, remote_cluster, target_bucket) + self.cluster_values, self._extract_values((spec,), data)[0]))
+                extracted = time.perf_counter()
+                for spec, label_values, metric_value in values:
+                    if metric_value is not False:
+                        self._add_value(spec, label_values, metric_value)
+                self._phase_time('extract', 'bucket_xdcr_stats', extracted - start)
+                self._phase_time('build', 'bucket_xdcr_stats', time.perf_counter() - extracted)
 
     """
     Clear gauges
     """
     def _clear_gauges(self):
         self.gauges = {}
+        with self.request_lock:
+            self.phase_seconds = {}
+        self.durations = {}
+        self.failures = 0
+        self.failed_groups = set()
+        self.signature = None
+        self.nodes = None
 
     """
-    Collect each metric defined in external module statsmetrics
+    Scrape health: couchbase_up, and errors and duration per endpoint
     """
-    def collect(self):
+    def _scrape_metrics(self):
+        cluster_labels, cluster_values = self.cluster_labels, self.cluster_values
+        with self.request_lock:
+            errors = dict(self.errors)
+        up = GaugeMetricFamily(self.METRIC_PREFIX + 'up', 'Whether the couchbase api answered the last scrape', labels=cluster_labels)
+        up.add_metric(cluster_values, 1 if self.failures < len(self.durations) or not self.failures else 0)
+        error_count = CounterMetricFamily(self.METRIC_PREFIX + 'scrape_errors', 'Failed requests per couchbase endpoint', labels=('endpoint',) + cluster_labels)
+        for endpoint in sorted(set(errors) | set(self.durations)):
+            error_count.add_metric((endpoint,) + cluster_values, errors.get(endpoint, 0))
+        duration = GaugeMetricFamily(self.METRIC_PREFIX + 'scrape_duration_seconds', 'Duration of the last request per couchbase endpoint', labels=('endpoint',) + cluster_labels)
+        for endpoint, seconds in sorted(self.durations.items()):
+            duration.add_metric((endpoint,) + cluster_values, seconds)
+        families = [up, error_count, duration]
+        if self.topology_ttl:
+            hits = CounterMetricFamily(self.METRIC_PREFIX + 'exporter_topology_cache_hits', 'Scrapes that reused the cached bucket list', labels=cluster_labels)
+            hits.add_metric(cluster_values, self.topology_hits)
+            misses = CounterMetricFamily(self.METRIC_PREFIX + 'exporter_topology_cache_misses', 'Scrapes that had to wait for the bucket list', labels=cluster_labels)
+            misses.add_metric(cluster_values, self.topology_misses)
+            families.extend([hits, misses])
+        if self.group_intervals:
+            age = GaugeMetricFamily(self.METRIC_PREFIX + 'exporter_group_age_seconds', 'Seconds since the metrics of a group were refreshed from couchbase', labels=('group',) + cluster_labels)
+            for name in REFRESH_GROUPS:
+                if name in self.group_cache:
+                    age.add_metric((name,) + cluster_values, time.time() - self.group_cache[name][1])
+            families.append(age)
+        return families
+
+    """
+    Request count, latency and opened connections of the http session
+    """
+    def _session_metrics(self):
+        with self.request_lock:
+            count, seconds = self.request_count, self.request_seconds
+        cluster_labels, cluster_values = self.cluster_labels, self.cluster_values
+        connections = CounterMetricFamily(self.METRIC_PREFIX + 'exporter_http_connections', 'Connections opened to couchbase, one handshake each', labels=cluster_labels)
+        connections.add_metric(cluster_values, self._connection_count())
+        latency = SummaryMetricFamily(self.METRIC_PREFIX + 'exporter_http_request_duration_seconds', 'Latency of successful requests to couchbase', labels=cluster_labels)
+        latency.add_metric(cluster_values, count_value=count, sum_value=seconds)
+        return [connections, latency, self._phase_metrics()]
+
+    """
+    Histogram of the seconds each scrape spent per phase and refresh group.
+    fetch and decode are summed over the group's requests
+    """
+    def _phase_metrics(self):
+        with self.request_lock:
+            histograms = dict((key, (list(counts), total)) for key, (counts, total) in self.phase_histograms.items())
+        phases = HistogramMetricFamily(self.METRIC_PREFIX + 'exporter_phase_duration_seconds', 'Seconds a scrape spent fetching, decoding, extracting and building metrics per group',
+            labels=('phase', 'group') + self.cluster_labels)
+        for (phase, group), (counts, total) in sorted(histograms.items()):
+            buckets = []
+            for bound, count in zip(PHASE_BUCKETS + (float('inf'),), counts):
+                buckets.append((floatToGoString(bound), count + (buckets[-1][1] if buckets else 0)))
+            phases.add_metric((phase, group) + self.cluster_values, buckets, total)
+        return phases
+
+    """
+    Refresh groups whose interval has passed since their last refresh, every
+    group without an interval or without a cached result yet
+    """
+    def _due_groups(self, now):
+        due = set()
+        for name in self.groups:
+            cached = self.group_cache.get(name)
+            if cached is None or now - cached[1] >= self.group_intervals.get(name, 0):
+                due.add(name)
+        return frozenset(due)
+
+    """
+    Families of this scrape in refresh group order. Groups that were not
+    due, or came back empty because their requests failed, are served from
+    their last refresh
+    """
+    def _group_families(self, now):
+        if not self.group_intervals:
+            return list(self.gauges.values())
+        fresh = dict((name, []) for name in REFRESH_GROUPS)
+        for family_name, gauge in self.gauges.items():
+            fresh[self.family_groups[family_name]].append(gauge)
+        families = []
+        for name in REFRESH_GROUPS:
+            if name in self.due and (fresh[name] or name not in self.failed_groups):
+                self.group_cache[name] = (fresh[name], now)
+            families.extend(self.group_cache.get(name, ([], now))[0])
+        return families
+
+    """
+    Request and build every metric defined in get_metrics that is due
+    """
+    def _scrape(self):
+        catalogue, self.pending_catalogue = self.pending_catalogue, None
+        if catalogue is not None:
+            self._apply_catalogue(*catalogue)
         self._clear_gauges()
-        for api_key,api_values in self.metrics.items():
-            # Request data for each url
-            couchbase_data = self._request_data(self.BASE_URL + api_values['url'])
-            self._collect_metrics(api_key, api_values, api_values['url'], couchbase_data)
+        now = time.time()
+        self.due = self._due_groups(now)
+        stats, xdcr = 'bucket_stats' in self.due, 'bucket_xdcr_stats' in self.due
+        # The bucket list is also needed for due bucket stats until one is
+        # known, or on every scrape when no bucket metrics are selected
+        fetch = [group for group in self.plan if group.key in self.due
+            or (group.key == 'buckets' and (stats or xdcr) and (self.topology is None or 'buckets' not in self.groups))]
+        # Request data for each url, plus every bucket of a cached topology
+        urls = [self.BASE_URL + group.url + GROUP_QUERIES.get(group.key, '') for group in fetch]
+        wanted = [None] * len(urls)
+        topology = self._cached_topology() if 'buckets' in self.due else self.topology
+        buckets_group = [group for group in self.plan if group.key == 'buckets']
+        prefetch = topology is not None and buckets_group and (stats or xdcr)
+        if prefetch:
+            nodes = (topology.nodes if self.per_node_stats else ()) if stats else ()
+            bucket_urls, bucket_wanted = self._bucket_urls(buckets_group[0], topology.buckets, nodes, stats, xdcr)
+            urls.extend(bucket_urls)
+            wanted.extend(bucket_wanted)
+        # Prefetched responses are only recorded when used, so requests for
+        # buckets deleted since the topology was cached are not errors
+        responses = self._request_all(urls, wanted, record=False)
+        group_data = dict((group.key, self._record_request(*next(responses))) for group in fetch)
+        if prefetch:
+            self.prefetched = ((topology.buckets, nodes, stats, xdcr), (self._record_request(*response) for response in responses))
+        for group in self.plan:
+            self._collect_metrics(group, group_data.get(group.key))
+        self.prefetched = None
+        self._observe_phases()
+        return self._group_families(now) + self._scrape_metrics()
+
+    """
+    Scrape, under the profiler while a profile capture is pending
+    """
+    def _profiled_scrape(self):
+        capture = self.profile_capture
+        if capture is None:
+            return self._scrape()
+        return capture.run(self._scrape)
+
+    """
+    Scrape couchbase and replace the snapshot served by collect
+    """
+    def refresh(self):
+        start = time.time()
+        families = self._profiled_scrape()
+        end = time.time()
+        self.snapshot = (families, end, end - start)
+
+    """
+    Age and build time of the cached snapshot
+    """
+    def _snapshot_metrics(self, refreshed_at, duration):
+        cluster_labels, cluster_values = self.cluster_labels, self.cluster_values
+        age = GaugeMetricFamily(self.METRIC_PREFIX + 'exporter_snapshot_age_seconds', 'Seconds since the served metrics were scraped from couchbase', labels=cluster_labels)
+        age.add_metric(cluster_values, time.time() - refreshed_at)
+        last = GaugeMetricFamily(self.METRIC_PREFIX + 'exporter_last_refresh_duration_seconds', 'Duration of the last background scrape of couchbase', labels=cluster_labels)
+        last.add_metric(cluster_values, duration)
+        return [age, last]
+
+    """
+    Collect each metric defined in external module statsmetrics, either
+    scraped now or from the snapshot kept by the background refresh
+    """
+    def collect(self):
+        if not self.refresh_interval:
+            for gauge in self._profiled_scrape():
+                yield gauge
+        elif self.snapshot is not None:
+            families, refreshed_at, duration = self.snapshot
+            for gauge in families:
+                yield gauge
+            for metric in self._snapshot_metrics(refreshed_at, duration):
+                yield metric
+        for metric in self._session_metrics():
+            yield metric
+
+"""
+cProfile of the next scrapes, shared by every collector so the scrapes of
+all clusters count towards the requested number. cProfile only sees the
+thread that enabled it, so requests run by the -w pool get a profile per
+pool thread, merged into the dump
+"""
+class ProfileCapture(object):
+
+    def __init__(self, scrapes):
+        self.profile = cProfile.Profile()
+        self.thread_profiles = {}
+        self.threads_lock = threading.Lock()
+        self.scrapes = scrapes
+        self.captured = 0
+        self.active = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    """
+    Run scrape under the profiler until enough scrapes were captured,
+    profiled scrapes run one at a time
+    """
+    def run(self, scrape):
+        with self.lock:
+            if self.captured < self.scrapes:
+                self.profile.enable()
+                self.active = True
+                try:
+                    return scrape()
+                finally:
+                    self.active = False
+                    self.profile.disable()
+                    self.captured += 1
+                    if self.captured >= self.scrapes:
+                        self.done.set()
+        return scrape()
+
+    """
+    Wrap func to run under the profile of the pool thread calling it
+    """
+    def profiled(self, func):
+        def run(*args):
+            with self.threads_lock:
+                profile = self.thread_profiles.setdefault(threading.get_ident(), cProfile.Profile())
+            try:
+                profile.enable()
+            except ValueError:
+                # Profilers built on sys.monitoring already see every thread
+                return func(*args)
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+        return run
+
+    """
+    Captured profile in the pstats file format, None before the first scrape
+    """
+    def dump(self):
+        with self.lock:
+            if not self.captured:
+                return None
+            stats = pstats.Stats(self.profile)
+            with self.threads_lock:
+                for profile in self.thread_profiles.values():
+                    stats.add(profile)
+            return marshal.dumps(stats.stats)
+
+PROFILE_PATH = '/debug/profile'
+PROFILE_LOCK = threading.Lock()
+
+"""
+Profile the next scrapes of collectors, waiting at most timeout seconds
+for them. None when another capture is already running
+"""
+def capture_profile(collectors, scrapes, timeout):
+    if not PROFILE_LOCK.acquire(False):
+        return None
+    try:
+        capture = ProfileCapture(scrapes)
+        for collector in collectors:
+            collector.profile_capture = capture
+        capture.done.wait(timeout)
+        for collector in collectors:
+            collector.profile_capture = None
+        return capture
+    finally:
+        PROFILE_LOCK.release()
+
+"""
+Debug endpoint: GET /debug/profile?scrapes=N&timeout=S returns a cProfile
+of the next N scrapes as a pstats file, for pstats or snakeviz
+"""
+class ProfileHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path != PROFILE_PATH:
+            return self._respond(404, b'Requested resource not found.')
+        try:
+            scrapes = max(1, int(query.get('scrapes', ['1'])[0]))
+            timeout = float(query.get('timeout', ['300'])[0])
+        except ValueError:
+            return self._respond(400, b'scrapes and timeout must be numbers')
+        capture = capture_profile(self.server.collectors, scrapes, timeout)
+        if capture is None:
+            return self._respond(409, b'Another profile is being captured')
+        body = capture.dump()
+        if body is None:
+            return self._respond(504, 'No scrape within {0} seconds'.format(timeout).encode('utf-8'))
+        self._respond(200, body, 'application/octet-stream',
+            {'Content-Disposition': 'attachment; filename="couchbase_exporter_{0}.pstats"'.format(int(time.time()))})
+
+    def _respond(self, status, body, content_type='text/plain', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
 
-        for gauge_name, gauge in self.gauges.items():
-            yield gauge
+    def log_message(self, format, *args):
+        pass
+
+"""
+Serve the profile endpoint for collectors in a daemon thread
+"""
+def start_profile_server(port, collectors):
+    server = ThreadingHTTPServer(('', port), ProfileHandler)
+    server.daemon_threads = True
+    server.collectors = collectors
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+EXPOSITION_PATHS = ('/', '/metrics')
+OPENMETRICS_EOF = b'# EOF\n'
+SNAPSHOT_AGE = CouchbaseCollector.METRIC_PREFIX + 'exporter_snapshot_age_seconds'
+
+"""
+Registry stand-in returning families collected once, so every format is
+rendered from the same collection
+"""
+class CollectedRegistry(object):
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+"""
+Render registry once into immutable response bytes, keyed by (openmetrics,
+gzip) and holding (content type, body, compressor): the text format, plus
+OpenMetrics without its EOF when enabled, each plain and gzipped. The
+snapshot age is left out and returned with the render time, to be rendered
+per request. The gzip stream is flushed but left open, its compressor
+finishes it with the age
+"""
+def render_exposition(registry, openmetrics=False):
+    rendered_at = time.time()
+    families = list(registry.collect())
+    ages = [family for family in families if family.name == SNAPSHOT_AGE]
+    collected = CollectedRegistry([family for family in families if family.name != SNAPSHOT_AGE])
+    formats = [(False, CONTENT_TYPE_TEXT, generate_latest)]
+    if openmetrics:
+        formats.append((True, CONTENT_TYPE_OPENMETRICS, generate_openmetrics))
+    exposition = {}
+    for is_openmetrics, content_type, generate in formats:
+        body = generate(collected)
+        if is_openmetrics:
+            body = body[:-len(OPENMETRICS_EOF)]
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        exposition[(is_openmetrics, False)] = (content_type, body, None)
+        exposition[(is_openmetrics, True)] = (content_type, compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor)
+    return exposition, (ages[0] if ages else None, rendered_at)
+
+"""
+Snapshot age family rendered as of now, aged by the time since the render,
+closing the OpenMetrics body. With a compressor it is compressed by a copy
+of it, ending the gzip stream of the rendered body
+"""
+def render_age(ages, openmetrics, compressor=None):
+    family, rendered_at = ages
+    families = []
+    if family is not None:
+        elapsed = time.time() - rendered_at
+        family = copy.copy(family)
+        family.samples = [sample._replace(value=sample.value + elapsed) for sample in family.samples]
+        families.append(family)
+    body = (generate_openmetrics if openmetrics else generate_latest)(CollectedRegistry(families))
+    if compressor is None:
+        return body
+    compressor = compressor.copy()
+    return compressor.compress(body) + compressor.flush()
+
+"""
+asyncio http server for a pre-rendered exposition. render() replaces the
+responses after every refresh, requests only pick the variant matching
+their Accept and Accept-Encoding headers and write it, rendering nothing
+but the snapshot age so it keeps growing when refreshes fail
+"""
+class ExpositionServer(object):
+
+    def __init__(self, registry, openmetrics=False):
+        self.registry = registry
+        self.openmetrics = openmetrics
+        self.responses = None
+
+    """
+    Render the registry and swap in the new responses
+    """
+    def render(self):
+        self.responses = render_exposition(self.registry, self.openmetrics)
+
+    """
+    Head and body parts for a request, plain text errors for unknown paths
+    and before the first render
+    """
+    def response(self, method, path, headers):
+        responses = self.responses
+        if method not in ('GET', 'HEAD'):
+            return self._error(405, 'Method Not Allowed')
+        if path.split('?')[0] not in EXPOSITION_PATHS:
+            return self._error(404, 'Not Found')
+        if responses is None:
+            return self._error(503, 'Service Unavailable')
+        exposition, ages = responses
+        accept = [value.split(';')[0].strip() for value in headers.get('accept', '').split(',')]
+        encodings = [value.split(';')[0].strip().lower() for value in headers.get('accept-encoding', '').split(',')]
+        openmetrics = self.openmetrics and 'application/openmetrics-text' in accept
+        gzipped = 'gzip' in encodings
+        content_type, body, compressor = exposition[(openmetrics, gzipped)]
+        age = render_age(ages, openmetrics, compressor)
+        head = 'HTTP/1.1 200 OK\r\nContent-Type: {0}\r\nContent-Length: {1}\r\n{2}\r\n'.format(
+            content_type, len(body) + len(age), 'Content-Encoding: gzip\r\nVary: Accept-Encoding\r\n' if gzipped else 'Vary: Accept-Encoding\r\n')
+        return head.encode('latin-1'), [body, age]
+
+    def _error(self, status, reason):
+        body = reason.encode('latin-1')
+        head = 'HTTP/1.1 {0} {1}\r\nContent-Type: text/plain\r\nContent-Length: {2}\r\n\r\n'.format(status, reason, len(body))
+        return head.encode('latin-1'), [body]
+
+    """
+    Serve the requests of one keep-alive connection
+    """
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                lines = request.decode('latin-1').split('\r\n')
+                method, path, version = (lines[0].split(' ') + ['', ''])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                head, body = self.response(method, path, headers)
+                writer.write(head)
+                if method != 'HEAD':
+                    writer.writelines(body)
+                await writer.drain()
+                connection = headers.get('connection', '').lower()
+                if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    """
+    Run the event loop in a daemon thread
+    """
+    def serve(self, port, address=''):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle, address or None, port, backlog=512))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+class MultiClusterCollector(object):
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+        self.executor = ThreadPoolExecutor(max_workers=len(collectors))
+
+    """
+    Run func for every cluster concurrently. A failing cluster is reported
+    and skipped so the other clusters are still served
+    """
+    def _each_cluster(self, func):
+        futures = [(collector, self.executor.submit(func, collector)) for collector in self.collectors]
+        results = []
+        for collector, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print('Failed to scrape cluster {0} ({1}): {2!r}'.format(collector.cluster, collector.BASE_URL, e))
+        return results
+
+    """
+    Refresh every cluster snapshot
+    """
+    def refresh(self):
+        self._each_cluster(lambda collector: collector.refresh())
+
+    """
+    Collect every cluster and merge families of the same name, each sample
+    carries its cluster label
+    """
+    def collect(self):
+        merged = {}
+        for families in self._each_cluster(lambda collector: list(collector.collect())):
+            for family in families:
+                if family.name in merged:
+                    merged[family.name].samples.extend(family.samples)
+                else:
+                    merged[family.name] = copy.copy(family)
+                    merged[family.name].samples = list(family.samples)
+        for family in merged.values():
+            yield family
+
+"""
+Parse a --couchbase value, either url or name=url. Named or multiple
+targets get a cluster label, named after the url host when not given
+"""
+def parse_targets(values, labelled):
+    targets = []
+    for value in values:
+        name, _, url = value.rpartition('=')
+        if not name and labelled:
+            name = urlparse(url).netloc
+        targets.append((name or None, url))
+    return targets
+
+"""
+Parse --group-interval values, group=seconds, into a dict of refresh
+interval per group
+"""
+def parse_group_intervals(values):
+    intervals = {}
+    for value in values:
+        group, _, seconds = value.partition('=')
+        if group not in REFRESH_GROUPS:
+            raise ValueError('unknown group {0}, expected one of {1}'.format(group, ', '.join(REFRESH_GROUPS)))
+        intervals[group] = float(seconds)
+    return intervals
+
+"""
+Load the metric catalogue again on SIGHUP. A catalogue that fails to load
+is reported and the current one kept
+"""
+def reload_catalogue(path, collectors):
+    try:
+        metrics, bucket_patterns = load_catalogue(path)
+    except Exception as e:
+        print('Failed to reload metric catalogue {0}, keeping the current one: {1!r}'.format(path, e))
+        return
+    for collector in collectors:
+        collector.reload(metrics, bucket_patterns)
+    print('Reloaded metric catalogue {0}'.format(path))
+
+"""
+Refresh the collector snapshot every interval seconds, then call
+on_refresh, or just wait for the http server thread when metrics are
+scraped on request
+"""
+def run_scheduler(collector, interval, on_refresh=None):
+    if not interval:
+        while True: signal.pause()
+    while True:
+        start = time.time()
+        try:
+            collector.refresh()
+            if on_refresh is not None:
+                on_refresh()
+        except Exception as e:
+            print('Failed to refresh metrics, serving the previous snapshot: {0!r}'.format(e))
+        time.sleep(max(0, interval - (time.time() - start)))
 
 """
 Parse optional arguments
@@ -127,8 +1388,9 @@ def parse_args():
         '-c', '--couchbase',
         metavar='couchbase',
         required=False,
-        help='server url from the couchbase api',
-        default='http://127.0.0.1:8091'
+        action='append',
+        help='server url from the couchbase api, as url or name=url. Repeat to export several clusters',
+        default=None
     )
     parser.add_argument(
         '-p', '--port',
@@ -138,7 +1400,156 @@ def parse_args():
         help='Listen to this port',
         default=9420
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '-w', '--workers',
+        metavar='workers',
+        required=False,
+        type=int,
+        help='Maximum number of concurrent requests to couchbase, 1 fetches serially',
+        default=1
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Timeout for establishing a connection to couchbase',
+        default=5.0
+    )
+    parser.add_argument(
+        '--read-timeout',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Timeout for reading a response from couchbase',
+        default=30.0
+    )
+    parser.add_argument(
+        '--retries',
+        metavar='retries',
+        required=False,
+        type=int,
+        help='Retries for failed connections and 5xx responses',
+        default=2
+    )
+    parser.add_argument(
+        '--retry-backoff',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Backoff factor between retries',
+        default=0.5
+    )
+    parser.add_argument(
+        '--pool-size',
+        metavar='connections',
+        required=False,
+        type=int,
+        help='Keep-alive connections per couchbase host, defaults to --workers',
+        default=None
+    )
+    parser.add_argument(
+        '-i', '--refresh-interval',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Scrape couchbase in the background every interval and serve the cached result, 0 scrapes on every request',
+        default=0
+    )
+    parser.add_argument(
+        '--stats-aggregation',
+        metavar='aggregation',
+        required=False,
+        choices=sorted(AGGREGATIONS),
+        help='How bucket stats samples are reduced to one value: avg, max or last',
+        default='avg'
+    )
+    parser.add_argument(
+        '--stats-since-last',
+        required=False,
+        action='store_true',
+        help='Only request bucket stats samples newer than the previous scrape'
+    )
+    parser.add_argument(
+        '--decoder',
+        metavar='decoder',
+        required=False,
+        choices=sorted(DECODERS),
+        help='json decodes whole responses, stream only decodes the planned bucket stats (needs ijson)',
+        default='json'
+    )
+    parser.add_argument(
+        '--topology-ttl',
+        metavar='seconds',
+        required=False,
+        type=float,
+        help='Reuse the bucket list for this long, unless the cluster reports a change, and request bucket stats alongside it',
+        default=0
+    )
+    parser.add_argument(
+        '--per-node-stats',
+        required=False,
+        action='store_true',
+        help='Request bucket stats from every node listed in /pools/nodes/ instead of cluster wide, with a node label'
+    )
+    parser.add_argument(
+        '--aggregate-nodes',
+        required=False,
+        action='store_true',
+        help='With --per-node-stats also export the cluster level bucket stats, summed over the nodes'
+    )
+    parser.add_argument(
+        '--group-interval',
+        metavar='group=seconds',
+        required=False,
+        action='append',
+        help='Refresh a metric group (cluster, nodes, buckets, bucket_stats or bucket_xdcr_stats) only every interval and serve its cached result in between. Repeat for several groups',
+        default=None
+    )
+    parser.add_argument(
+        '--metrics-config',
+        metavar='path',
+        required=False,
+        help='YAML or JSON metric catalogue with include/exclude patterns for groups, metric ids and buckets, reloaded on SIGHUP',
+        default=None
+    )
+    parser.add_argument(
+        '--dump-metrics',
+        required=False,
+        action='store_true',
+        help='Print the built-in metric catalogue as JSON, a starting point for --metrics-config, and exit'
+    )
+    parser.add_argument(
+        '--profile-port',
+        metavar='port',
+        required=False,
+        type=int,
+        help='Serve /debug/profile?scrapes=N on this port, returning a cProfile of the next N scrapes as a pstats file. 0 disables it',
+        default=0
+    )
+    parser.add_argument(
+        '--http-server',
+        metavar='server',
+        required=False,
+        choices=['prometheus', 'async'],
+        help='prometheus renders the metrics for every request, async renders them once per --refresh-interval and serves the bytes from asyncio',
+        default='prometheus'
+    )
+    parser.add_argument(
+        '--openmetrics',
+        required=False,
+        action='store_true',
+        help='With --http-server async also render OpenMetrics, for scrapers that accept it'
+    )
+    args = parser.parse_args()
+    if args.http_server == 'async' and not args.refresh_interval:
+        parser.error('--http-server async needs --refresh-interval')
+    args.couchbase = args.couchbase or ['http://127.0.0.1:8091']
+    try:
+        args.group_interval = parse_group_intervals(args.group_interval or [])
+    except ValueError as e:
+        parser.error(str(e))
+    return args
 
 def get_metrics():
     return {
@@ -400,11 +1811,39 @@ def get_metrics():
 if __name__ == '__main__':
 	try:
 		args = parse_args()
+		if args.dump_metrics:
+			print(json.dumps({'metrics': get_metrics()}, indent=2))
+			exit(0)
 		port = int(args.port)
-		REGISTRY.register(CouchbaseCollector(args.couchbase, get_metrics()))
-		start_http_server(port)
+		try:
+			metrics, bucket_patterns = load_catalogue(args.metrics_config) if args.metrics_config else (get_metrics(), None)
+		except Exception as e:
+			print('Failed to load metric catalogue {0}: {1}'.format(args.metrics_config, e))
+			exit(1)
+		collectors = []
+		for cluster, url in parse_targets(args.couchbase, len(args.couchbase) > 1):
+			collectors.append(CouchbaseCollector(url, metrics, workers=args.workers,
+				connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, retries=args.retries,
+				retry_backoff=args.retry_backoff, pool_size=args.pool_size, refresh_interval=args.refresh_interval,
+				cluster=cluster, stats_aggregation=args.stats_aggregation, stats_since_last=args.stats_since_last,
+				decoder=args.decoder, topology_ttl=args.topology_ttl, per_node_stats=args.per_node_stats,
+				aggregate_nodes=args.aggregate_nodes, group_intervals=args.group_interval, bucket_patterns=bucket_patterns))
+		collector = collectors[0] if len(collectors) == 1 else MultiClusterCollector(collectors)
+		REGISTRY.register(collector)
+		if args.metrics_config:
+			signal.signal(signal.SIGHUP, lambda signum, frame: reload_catalogue(args.metrics_config, collectors))
+		on_refresh = None
+		if args.http_server == 'async':
+			server = ExpositionServer(REGISTRY, args.openmetrics)
+			server.serve(port)
+			on_refresh = server.render
+		else:
+			start_http_server(port)
 		print("Serving at port: %s" % port)
-		while True: time.sleep(0.25)
+		if args.profile_port:
+			start_profile_server(args.profile_port, collectors)
+			print("Serving %s at port: %s" % (PROFILE_PATH, args.profile_port))
+		run_scheduler(collector, args.refresh_interval, on_refresh)
 	except KeyboardInterrupt:
 		print(" Interrupted")
 		exit(0)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+Recorded-shape Couchbase REST payloads for benchmarks. The documents mirror
+/pools/default/, /pools/nodes/, /pools/default/buckets/ and the per-bucket
+stats and @xdcr- stats responses, including the keys the exporter never
+reads, and are generated from a seed so every run sees the same data.
+"""
+from couchbase_exporter import get_metrics
+import random
+
+SAMPLES = 60
+EXTRA_STATS = 100
+
+"""
+Build a nested dict holding a value for every dotted id
+"""
+def _tree(ids, value):
+    tree = {}
+    for metric_id in ids:
+        node = tree
+        parts = metric_id.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value()
+    return tree
+
+"""
+Return a dict of url path to decoded JSON document for a cluster with the
+given number of buckets, nodes and XDCR replications per bucket. hostnames
+overrides the host:port of the nodes
+"""
+def build_payloads(buckets=10, nodes=3, replications=2, samples=SAMPLES, seed=0, hostnames=None):
+    metrics = get_metrics()
+    rand = random.Random(seed)
+    value = lambda: rand.randint(0, 1 << 20)
+    timestamps = [1500000000000 + 1000 * i for i in range(samples)]
+    stat_ids = [m['id'] for m in metrics['buckets']['bucket_stats']] + ['unused_stat_%d' % i for i in range(EXTRA_STATS)]
+    xdcr_ids = [m['id'] for m in metrics['buckets']['bucket_xdcr_stats']] + ['docs_written', 'docs_processed', 'bandwidth_usage', 'rate_replicated']
+
+    payloads = {}
+    payloads['/pools/default/'] = _tree([m['id'] for m in metrics['cluster']['metrics']], value)
+    payloads['/pools/default/']['buckets'] = {'uri': '/pools/default/buckets?v=%d&uuid=fixture' % seed}
+    payloads['/pools/default/']['nodes'] = []
+
+    node_list = []
+    for index in range(nodes):
+        node = _tree([m['id'] for m in metrics['nodes']['metrics']], value)
+        node.update({
+            'hostname': hostnames[index] if hostnames else '10.0.0.%d:8091' % (index + 1),
+            'clusterMembership': 'active',
+            'status': 'healthy',
+            'services': ['kv', 'index', 'n1ql'],
+            'ports': {'direct': 11210, 'proxy': 11211},
+            'version': '5.0.1-5003-enterprise',
+        })
+        node_list.append(node)
+    payloads['/pools/nodes/'] = {'name': 'nodes', 'nodes': node_list}
+    payloads['/pools/default/']['nodes'] = node_list
+
+    bucket_list = []
+    for index in range(buckets):
+        name = 'bucket%d' % index
+        bucket = _tree([m['id'] for m in metrics['buckets']['metrics']], value)
+        bucket.update({
+            'name': name,
+            'bucketType': 'membase',
+            'uri': '/pools/default/buckets/%s?bucket_uuid=%032x' % (name, index),
+            'stats': {
+                'uri': '/pools/default/buckets/%s/stats' % name,
+                'directoryURI': '/pools/default/buckets/%s/statsDirectory' % name,
+                'nodeStatsListURI': '/pools/default/buckets/%s/nodes' % name,
+            },
+            'nodes': [{'hostname': node['hostname']} for node in node_list],
+            'vBucketServerMap': {'vBucketMap': [[rand.randint(0, nodes - 1), -1] for _ in range(1024)]},
+        })
+        bucket_list.append(bucket)
+
+        stats = dict((stat_id, [value() for _ in range(samples)]) for stat_id in stat_ids)
+        stats['timestamp'] = list(timestamps)
+        payloads['/pools/default/buckets/%s/stats' % name] = {
+            'op': {'samples': stats, 'samplesCount': samples, 'isPersistent': True, 'lastTStamp': timestamps[-1], 'interval': 1000},
+            'hot_keys': [],
+        }
+
+        xdcr = {'timestamp': list(timestamps)}
+        for replication in range(replications):
+            for stat_id in xdcr_ids:
+                key = 'replications/%032x/%s/target%d/%s' % (replication, name, replication, stat_id)
+                xdcr[key] = [value() for _ in range(samples)]
+        payloads['/pools/default/buckets/@xdcr-%s/stats' % name] = {
+            'op': {'samples': xdcr, 'samplesCount': samples, 'isPersistent': True, 'lastTStamp': timestamps[-1], 'interval': 1000},
+        }
+    payloads['/pools/default/buckets/'] = bucket_list
+    return payloads
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the Couchbase REST API, replaying the couchbase_fixtures.py
+payloads for /pools/default/, /pools/nodes/, /pools/default/buckets/ (honouring
+skipMap) and the per-bucket stats and @xdcr- stats, with optional latency per
+request. Every node listens on its own loopback address, 127.0.0.<n>:port, and
+serves the per-node bucket stats as well. Where only 127.0.0.1 can be bound,
+as on macOS, the nodes listen on separate ports of 127.0.0.1 instead.
+__Usage:__ couchbase_mock_server.py [-p port] [-b buckets] [-n nodes] [-l latency_ms]
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from couchbase_fixtures import build_payloads
+import argparse, json, re, socket, threading, time
+
+STATS_PATH = '/mock/stats'
+NODE_STATS = re.compile(r'^(/pools/default/buckets/[^/]+)/nodes/[^/]+(/stats)$')
+
+class MockCouchbase(object):
+
+    def __init__(self, buckets=10, nodes=3, replications=2, samples=60, latency=0.0, hostnames=None):
+        self.payloads = build_payloads(buckets, nodes, replications, samples, hostnames=hostnames)
+        self.encoded = dict((path, json.dumps(payload).encode('utf-8')) for path, payload in self.payloads.items())
+        buckets = [dict((key, value) for key, value in bucket.items() if key != 'vBucketServerMap') for bucket in self.payloads['/pools/default/buckets/']]
+        self.skip_map = json.dumps(buckets).encode('utf-8')
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.hosts = {}
+
+    """
+    Stats documents with their sample timestamps ending now, filtered to the
+    samples newer than haveTStamp when the exporter asks for it
+    """
+    def _stats(self, path, query):
+        document = self.payloads[path]
+        samples = document['op']['samples']
+        count = len(samples['timestamp'])
+        end = int(time.time()) * 1000
+        timestamps = [end - 1000 * (count - 1 - index) for index in range(count)]
+        start = 0
+        if 'haveTStamp' in query:
+            since = int(query['haveTStamp'][0])
+            start = len([timestamp for timestamp in timestamps if timestamp <= since])
+        op = dict(document['op'])
+        op['samples'] = dict((key, values[start:]) for key, values in samples.items())
+        op['samples']['timestamp'] = timestamps[start:]
+        op['samplesCount'] = count - start
+        op['lastTStamp'] = end
+        return json.dumps(dict(document, op=op)).encode('utf-8')
+
+    """
+    Body for a request path on host, None when the path is unknown
+    """
+    def response(self, path, query, host=None):
+        if path == STATS_PATH:
+            with self.lock:
+                return json.dumps({'requests': self.requests, 'bytes': self.bytes, 'hosts': self.hosts}).encode('utf-8')
+        path = NODE_STATS.sub(r'\1\2', path)
+        if path not in self.encoded:
+            return None
+        if path.endswith('/stats'):
+            body = self._stats(path, query)
+        elif path == '/pools/default/buckets/' and query.get('skipMap') == ['true']:
+            body = self.skip_map
+        else:
+            body = self.encoded[path]
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(body)
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+        return body
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, avoid delayed ACK stalls on keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        body = self.server.mock.response(url.path, parse_qs(url.query), '%s:%d' % self.server.server_address)
+        if body is None:
+            self.send_response(404)
+            body = b'Requested resource not found.'
+            self.send_header('Content-Type', 'text/plain')
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+"""
+Start serving mock on port in a daemon thread, 0 picks a free port
+"""
+def serve(mock, port=0, address='127.0.0.1'):
+    server = ThreadingHTTPServer((address, port), MockHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+"""
+Serve mock as a cluster of nodes, one server per (address, port)
+"""
+def serve_cluster(mock, addresses):
+    return [serve(mock, port, address) for address, port in addresses]
+
+"""
+A port that is free on 127.0.0.1
+"""
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+"""
+Whether loopback addresses besides 127.0.0.1 can be bound, true on Linux
+but not on macOS
+"""
+def loopback_aliases():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.2', 0))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+"""
+(address, port) of each node: 127.0.0.<n>:port, or 127.0.0.1 with port for
+the first node and free ports for the others without loopback aliases
+"""
+def node_addresses(port, nodes):
+    if loopback_aliases():
+        return [('127.0.0.%d' % (index + 1), port) for index in range(nodes)]
+    return [('127.0.0.1', port)] + [('127.0.0.1', free_port()) for _ in range(1, nodes)]
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='mock couchbase rest api'
+    )
+    parser.add_argument('-p', '--port', type=int, default=8091, help='Listen to this port')
+    parser.add_argument('-b', '--buckets', type=int, default=10, help='buckets in the cluster')
+    parser.add_argument('-n', '--nodes', type=int, default=3, help='nodes in the cluster')
+    parser.add_argument('-r', '--replications', type=int, default=2, help='XDCR replications per bucket')
+    parser.add_argument('--samples', type=int, default=60, help='samples per stat')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='milliseconds added to every request')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+	try:
+		args = parse_args()
+		port = args.port or free_port()
+		addresses = node_addresses(port, args.nodes)
+		hostnames = ['%s:%d' % address for address in addresses]
+		serve_cluster(MockCouchbase(args.buckets, args.nodes, args.replications, args.samples, args.latency / 1000.0, hostnames), addresses)
+		print("Serving at port: %s" % port)
+		while True: time.sleep(3600)
+	except KeyboardInterrupt:
+		print(" Interrupted")
+		exit(0)
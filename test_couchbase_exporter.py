@@ -0,0 +1,426 @@
+"""
+Checks of couchbase_exporter.py against the couchbase_fixtures.py payloads
+and the couchbase_mock_server.py cluster.
+__Usage:__ python -m pytest test_couchbase_exporter.py
+"""
+from urllib.parse import urlparse
+from couchbase_exporter import CouchbaseCollector, CouchbaseRequestError, ExpositionServer, MultiClusterCollector, ProfileCapture, get_metrics, load_catalogue, parse_targets, reload_catalogue
+from couchbase_fixtures import build_payloads
+from couchbase_mock_server import MockCouchbase, serve_cluster, free_port, node_addresses
+import couchbase_exporter
+import couchbase_mock_server
+from prometheus_client import CollectorRegistry
+from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.openmetrics.parser import text_string_to_metric_families as openmetrics_families
+import gzip
+import json
+import marshal
+import os
+import pytest
+import subprocess
+import sys
+import time
+
+BASE_URL = 'http://fixture:8091'
+# Self metrics vary between scrapes, the stats timestamp with the clock
+VOLATILE = ('couchbase_exporter_', 'couchbase_scrape_', 'couchbase_bucket_stats_timestamp', 'couchbase_bucket_node_stats_timestamp')
+
+@pytest.fixture(scope='module')
+def payloads():
+    return build_payloads(buckets=4, nodes=3, replications=2, samples=10)
+
+@pytest.fixture(scope='module')
+def mock():
+    addresses = node_addresses(free_port(), 3)
+    mock = MockCouchbase(4, 3, 2, 10, hostnames=['%s:%d' % address for address in addresses])
+    servers = serve_cluster(mock, addresses)
+    mock.url = 'http://%s:%d' % addresses[0]
+    yield mock
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+"""
+Collector answering every request from payloads instead of over http
+"""
+def fixture_collector(payloads, metrics=None, **options):
+    collector = CouchbaseCollector(BASE_URL, metrics or get_metrics(), **options)
+    def request_data(url, wanted=None):
+        path = urlparse(url).path
+        if path not in payloads:
+            raise CouchbaseRequestError('Response Status (404): {0}'.format(path))
+        return payloads[path]
+    collector._request_data = request_data
+    return collector
+
+"""
+{(sample name, labels): value} of one collect, without volatile series
+"""
+def scrape(collector, volatile=VOLATILE):
+    return dict(((sample.name, tuple(sorted(sample.labels.items()))), sample.value)
+        for family in collector.collect() if not family.name.startswith(volatile) for sample in family.samples)
+
+def values(samples, name):
+    return dict((labels, value) for (sample_name, labels), value in samples.items() if sample_name == name)
+
+"""
+Requests the mock served during one scrape of collector, and its samples
+"""
+def counted_scrape(mock, collector):
+    before = mock.requests
+    samples = scrape(collector)
+    return mock.requests - before, samples
+
+def test_mock_serves_payloads(mock):
+    # The mock only rewrites stats timestamps, which scrape leaves out
+    assert scrape(CouchbaseCollector(mock.url, get_metrics())) == scrape(fixture_collector(mock.payloads))
+
+def test_workers_match_serial(payloads):
+    serial = scrape(fixture_collector(payloads))
+    assert serial
+    assert scrape(fixture_collector(payloads, workers=4)) == serial
+
+def test_index_xdcr():
+    collector = CouchbaseCollector(BASE_URL, get_metrics())
+    index = collector._index_xdcr({
+        'replications/uuid1/bucket0/target0/percent_completeness': [10, 20],
+        'replications/uuid2/bucket0/target1/percent_completeness': [30],
+        'replication_changes_left': [5],
+        'percent_completeness': [99],
+    })
+    assert sorted(index['percent_completeness']) == [('uuid1', 'target0', [10, 20]), ('uuid2', 'target1', [30])]
+    assert index['replication_changes_left'] == [('', '', [5])]
+
+def test_xdcr_series_per_replication(payloads):
+    series = values(scrape(fixture_collector(payloads)), 'couchbase_bucket_xdcr_stats_percent_completeness')
+    assert len(series) == 4 * 2
+    labels = dict(next(iter(series)))
+    assert labels['remote_cluster'] and labels['target_bucket'].startswith('target')
+
+def test_per_node_stats_aggregate(mock):
+    samples = scrape(CouchbaseCollector(mock.url, get_metrics(), per_node_stats=True, aggregate_nodes=True, workers=4))
+    node_values = values(samples, 'couchbase_bucket_node_stats_cmd_get')
+    assert len(node_values) == 4 * 3
+    for labels, total in values(samples, 'couchbase_bucket_stats_cmd_get').items():
+        bucket = dict(labels)['bucket']
+        assert total == sum(value for node_labels, value in node_values.items() if dict(node_labels)['bucket'] == bucket)
+
+def test_group_interval_serves_cache(mock):
+    collector = CouchbaseCollector(mock.url, get_metrics(), group_intervals={'bucket_stats': 3600, 'cluster': 3600})
+    first_requests, first = counted_scrape(mock, collector)
+    second_requests, second = counted_scrape(mock, collector)
+    # cluster, nodes, buckets and 4 bucket stats and XDCR stats, then no cluster and bucket stats
+    assert (first_requests, second_requests) == (11, 6)
+    assert second == first
+    ages = [family for family in collector.collect() if family.name == 'couchbase_exporter_group_age_seconds'][0]
+    assert set(sample.labels['group'] for sample in ages.samples) == set(['cluster', 'nodes', 'buckets', 'bucket_stats', 'bucket_xdcr_stats'])
+
+def test_catalogue_excludes_groups_metrics_and_buckets(mock, tmp_path):
+    path = str(tmp_path / 'metrics.json')
+    with open(path, 'w') as f:
+        json.dump({'exclude': {'groups': ['bucket_xdcr_stats'], 'metrics': ['vb_*'], 'buckets': ['bucket1']}}, f)
+    metrics, bucket_patterns = load_catalogue(path)
+    requests, samples = counted_scrape(mock, CouchbaseCollector(mock.url, metrics, bucket_patterns=bucket_patterns))
+    # cluster, nodes, buckets and the stats of 3 buckets, no XDCR
+    assert requests == 6
+    names = set(name for name, labels in samples)
+    assert not [name for name in names if name.startswith(('couchbase_bucket_xdcr_stats_', 'couchbase_bucket_stats_vb_'))]
+    assert 'couchbase_bucket_stats_cmd_get' in names
+    assert not [labels for name, labels in samples if dict(labels).get('bucket') == 'bucket1']
+
+def test_catalogue_include_selects_groups(payloads, tmp_path):
+    path = str(tmp_path / 'metrics.json')
+    with open(path, 'w') as f:
+        json.dump({'include': {'groups': ['cluster'], 'metrics': ['storageTotals.ram.*']}}, f)
+    metrics, bucket_patterns = load_catalogue(path)
+    assert list(metrics) == ['cluster']
+    names = set(name for name, labels in scrape(fixture_collector(payloads, metrics, bucket_patterns=bucket_patterns)))
+    assert names - set(['couchbase_up'])
+    assert all(name.startswith('couchbase_cluster_storagetotals_ram_') for name in names - set(['couchbase_up']))
+
+def test_connections_count_evicted_pools(mock):
+    collector = CouchbaseCollector(mock.url, get_metrics(), per_node_stats=True)
+    collector.session.adapters['http://'].poolmanager.pools._maxsize = 1
+    counts = []
+    for _ in range(2):
+        scrape(collector)
+        counts.append(collector._connection_count())
+    # Alternating between the nodes evicts their pools, so every scrape opens connections again
+    assert 0 < counts[0] < counts[1]
+
+def test_xdcr_empty_samples_and_aggregation(payloads):
+    payloads = dict(payloads)
+    path = '/pools/default/buckets/@xdcr-bucket0/stats'
+    samples = dict(payloads[path]['op']['samples'])
+    key = [key for key in samples if key.endswith('/target0/percent_completeness')][0]
+    samples[key] = []
+    payloads[path] = {'op': {'samples': samples}}
+    last = scrape(fixture_collector(payloads, stats_aggregation='last'))
+    series = values(last, 'couchbase_bucket_xdcr_stats_percent_completeness')
+    # The empty replication is skipped, every other one still exported
+    assert len(series) == 4 * 2 - 1
+    key = [key for key in samples if key.endswith('/target1/percent_completeness')][0]
+    assert samples[key][-1] in series.values()
+    assert values(last, 'couchbase_cluster_storagetotals_ram_total')
+
+def test_xdcr_labels_fixed(payloads):
+    # Catalogues written before the labels were fixed list them explicitly
+    legacy = get_metrics()
+    for metric in legacy['buckets']['bucket_xdcr_stats']:
+        metric['labels'] = ['name', 'bucket', 'remote_cluster', 'target_bucket']
+    series = values(scrape(fixture_collector(payloads)), 'couchbase_bucket_xdcr_stats_percent_completeness')
+    assert len(series) == 4 * 2
+    assert series == values(scrape(fixture_collector(payloads, legacy)), 'couchbase_bucket_xdcr_stats_percent_completeness')
+
+def test_stats_since_last_forgets_deleted_buckets(payloads, mock):
+    payloads = dict(payloads)
+    collector = fixture_collector(payloads, stats_since_last=True)
+    scrape(collector)
+    assert sorted(collector.stats_samples) == ['bucket0', 'bucket1', 'bucket2', 'bucket3']
+    payloads['/pools/default/buckets/'] = [bucket for bucket in payloads['/pools/default/buckets/'] if bucket['name'] != 'bucket3']
+    scrape(collector)
+    assert sorted(collector.stats_samples) == sorted(collector.stats_tstamps) == ['bucket0', 'bucket1', 'bucket2']
+
+    collector = CouchbaseCollector(mock.url, get_metrics(), stats_since_last=True, per_node_stats=True)
+    scrape(collector)
+    assert len(collector.stats_samples) == 4 * 3
+    collector._prune_stats((('bucket0', ''),), collector.nodes[:1])
+    assert list(collector.stats_samples) == [('bucket0', collector.nodes[0])]
+
+def test_deleted_bucket_is_no_scrape_error(payloads):
+    payloads = dict(payloads)
+    collector = fixture_collector(payloads, topology_ttl=3600, workers=4)
+    scrape(collector)
+    payloads['/pools/default/buckets/'] = [bucket for bucket in payloads['/pools/default/buckets/'] if bucket['name'] != 'bucket3']
+    del payloads['/pools/default/buckets/bucket3/stats']
+    del payloads['/pools/default/buckets/@xdcr-bucket3/stats']
+    scrape(collector)
+    # The prefetched requests for bucket3 failed, but were thrown away
+    assert (collector.topology_hits, collector.topology_misses) == (0, 2)
+    assert collector.errors == {}
+    assert collector.failures == 0
+    scrape(collector)
+    assert collector.topology_hits == 1
+
+def test_per_node_stats_aggregate_by_stat(mock):
+    metrics = get_metrics()
+    for metric in metrics['buckets']['bucket_stats']:
+        if metric['id'] == 'mem_total':
+            metric['node_aggregation'] = 'max'
+    collector = CouchbaseCollector(mock.url, metrics, per_node_stats=True, aggregate_nodes=True)
+    names = set(family.name for family in collector.collect())
+    assert 'couchbase_bucket_node_stats_timestamp' in names
+    assert 'couchbase_bucket_stats_timestamp' not in names
+    samples = scrape(collector)
+    # Every mock node serves the same stats, so only sums differ from the node value
+    for stat_id, nodes in [('cmd_get', 3), ('curr_items', 3), ('hit_ratio', 1), ('avg_bg_wait_time', 1),
+            ('ep_cache_miss_rate', 1), ('vb_avg_total_queue_age', 1), ('cpu_utilization_rate', 1), ('mem_total', 1)]:
+        node_value = values(samples, 'couchbase_bucket_node_stats_' + stat_id)
+        for labels, value in values(samples, 'couchbase_bucket_stats_' + stat_id).items():
+            bucket_node_value = [node for node_labels, node in node_value.items() if dict(node_labels)['bucket'] == dict(labels)['bucket']][0]
+            assert value == pytest.approx(nodes * bucket_node_value), stat_id
+
+def test_node_stats_url():
+    plain = CouchbaseCollector('http://host:8091', get_metrics())
+    assert plain._node_url('10.0.0.1:8091') == 'http://10.0.0.1:8091'
+    tls = CouchbaseCollector('https://host:18091', get_metrics())
+    assert tls._node_url('10.0.0.1:8091') == 'https://10.0.0.1:18091'
+    assert tls._node_url('10.0.0.1:8091', {'httpsMgmt': 28091}) == 'https://10.0.0.1:28091'
+    tls.node_urls = {'10.0.0.1:8091': tls._node_url('10.0.0.1:8091', {'httpsMgmt': 28091})}
+    group = [group for group in tls.plan if group.key == 'buckets'][0]
+    assert tls._node_stats_url(group, 'beer', '10.0.0.1:8091') == 'https://10.0.0.1:28091/pools/default/buckets/beer/nodes/10.0.0.1:8091/stats'
+
+def test_profile_capture_covers_workers(payloads):
+    collector = fixture_collector(payloads, workers=4)
+    capture = ProfileCapture(1)
+    collector.profile_capture = capture
+    scrape(collector)
+    assert capture.done.is_set()
+    functions = set(function for filename, line, function in marshal.loads(capture.dump()))
+    # fixture_collector's request_data only runs in the pool threads
+    assert 'request_data' in functions
+    assert '_scrape' in functions
+
+def test_exposition_snapshot_age_per_request(payloads):
+    registry = CollectorRegistry()
+    collector = fixture_collector(payloads, refresh_interval=60)
+    registry.register(collector)
+    collector.refresh()
+    server = ExpositionServer(registry, openmetrics=True)
+    server.render()
+    time.sleep(0.2)
+    for accept, parse in [('text/plain', text_string_to_metric_families), ('application/openmetrics-text', openmetrics_families)]:
+        for encoding in ('identity', 'gzip'):
+            head, parts = server.response('GET', '/metrics', {'accept': accept, 'accept-encoding': encoding})
+            body = b''.join(parts)
+            assert ('Content-Length: %d\r\n' % len(body)) in head.decode('latin-1')
+            if encoding == 'gzip':
+                body = gzip.decompress(body)
+            families = dict((family.name, family) for family in parse(body.decode('utf-8')))
+            assert 'couchbase_bucket_stats_cmd_get' in families
+            # Aged by the time since the render, not frozen at it
+            assert families['couchbase_exporter_snapshot_age_seconds'].samples[0].value >= 0.2
+    assert body.endswith(b'# EOF\n') and body.count(b'# EOF') == 1
+
+def test_mock_cluster_without_loopback_aliases(monkeypatch):
+    monkeypatch.setattr(couchbase_mock_server, 'loopback_aliases', lambda: False)
+    addresses = node_addresses(free_port(), 3)
+    assert [address for address, port in addresses] == ['127.0.0.1'] * 3
+    mock = MockCouchbase(1, 3, 1, 10, hostnames=['%s:%d' % address for address in addresses])
+    servers = serve_cluster(mock, addresses)
+    try:
+        samples = scrape(CouchbaseCollector('http://%s:%d' % addresses[0], get_metrics(), per_node_stats=True))
+        assert len(values(samples, 'couchbase_bucket_node_stats_cmd_get')) == 3
+        assert len(mock.hosts) == 3
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+def test_failing_endpoint_is_reported(payloads):
+    payloads = dict(payloads)
+    del payloads['/pools/default/buckets/bucket1/stats']
+    collector = fixture_collector(payloads)
+    for scrapes in (1, 2):
+        samples = scrape(collector, ())
+        errors = values(samples, 'couchbase_scrape_errors_total')
+        assert errors[(('endpoint', '/pools/default/buckets/bucket1/stats'),)] == scrapes
+        assert errors[(('endpoint', '/pools/default/'),)] == 0
+        assert values(samples, 'couchbase_up') == {(): 1}
+        # Everything but bucket1's stats is still exported
+        assert set(dict(labels)['bucket'] for labels in values(samples, 'couchbase_bucket_stats_cmd_get')) == set(['bucket0', 'bucket2', 'bucket3'])
+        assert len(values(samples, 'couchbase_bucket_basicstats_itemcount')) == 4
+        assert len(values(samples, 'couchbase_bucket_xdcr_stats_percent_completeness')) == 4 * 2
+        assert values(samples, 'couchbase_cluster_storagetotals_ram_total')
+        assert len(values(samples, 'couchbase_node_interestingstats_cmd_get')) == 3
+
+def test_unreachable_cluster_is_down():
+    collector = CouchbaseCollector('http://127.0.0.1:%d' % free_port(), get_metrics(), retries=0)
+    samples = scrape(collector, ())
+    assert values(samples, 'couchbase_up') == {(): 0}
+    errors = values(samples, 'couchbase_scrape_errors_total')
+    assert errors == dict(((('endpoint', endpoint),), 1) for endpoint in ('/pools/default/', '/pools/nodes/', '/pools/default/buckets/'))
+    assert not [name for name, labels in samples if not name.startswith(('couchbase_up', 'couchbase_scrape_', 'couchbase_exporter_'))]
+
+def test_multi_cluster_isolates_dead_cluster(mock):
+    dead = 'http://127.0.0.1:%d' % free_port()
+    assert parse_targets([mock.url], False) == [(None, mock.url)]
+    targets = parse_targets(['prod=' + mock.url, dead], True)
+    assert targets == [('prod', mock.url), (urlparse(dead).netloc, dead)]
+    collector = MultiClusterCollector([CouchbaseCollector(url, get_metrics(), cluster=cluster, retries=0) for cluster, url in targets])
+    names = [family.name for family in collector.collect()]
+    assert len(names) == len(set(names))
+    samples = scrape(collector)
+    assert values(samples, 'couchbase_up') == {(('cluster', 'prod'),): 1, (('cluster', targets[1][0]),): 0}
+    del samples[('couchbase_up', (('cluster', targets[1][0]),))]
+    # Every series of the live cluster, merged into one family per name, and nothing else of the dead one
+    assert samples == scrape(CouchbaseCollector(mock.url, get_metrics(), cluster='prod'))
+
+@pytest.mark.parametrize('options', [{}, {'per_node_stats': True, 'aggregate_nodes': True, 'workers': 4}])
+def test_stream_decoder_matches_json(mock, options):
+    pytest.importorskip('ijson')
+    assert scrape(CouchbaseCollector(mock.url, get_metrics(), decoder='stream', **options)) == scrape(CouchbaseCollector(mock.url, get_metrics(), **options))
+
+def test_stream_decoder_reuses_connections(mock, monkeypatch):
+    pytest.importorskip('ijson')
+    collector = CouchbaseCollector(mock.url, get_metrics(), decoder='stream')
+    scrape(collector)
+    assert collector._connection_count() == 1
+    def truncated(stream, wanted):
+        stream.read(16)
+        raise ValueError('truncated stats')
+    monkeypatch.setattr(couchbase_exporter, 'select_samples', truncated)
+    errors = values(scrape(collector, ()), 'couchbase_scrape_errors_total')
+    assert sorted(dict(labels)['endpoint'] for labels, count in errors.items() if count) == ['/pools/default/buckets/bucket%d/stats' % index for index in range(4)]
+    # Responses abandoned while streaming are drained and their connection reused, a leaked one would block the pool
+    assert collector._connection_count() == 1
+
+def test_aggregate_nodes_skips_partial_buckets():
+    addresses = node_addresses(free_port(), 3)
+    mock = MockCouchbase(2, 3, 1, 10, hostnames=['%s:%d' % address for address in addresses])
+    servers = serve_cluster(mock, addresses)
+    try:
+        collector = CouchbaseCollector('http://%s:%d' % addresses[0], get_metrics(), per_node_stats=True, aggregate_nodes=True, retries=0)
+        assert len(values(scrape(collector), 'couchbase_bucket_stats_cmd_get')) == 2
+        servers[2].shutdown()
+        servers[2].server_close()
+        # Drop the kept-alive connections, which the stopped node still serves
+        collector.session.close()
+        samples = scrape(collector, ())
+        # Two of three nodes answered, a sum over them would look like a drop
+        assert len(values(samples, 'couchbase_bucket_node_stats_cmd_get')) == 2 * 2
+        assert not values(samples, 'couchbase_bucket_stats_cmd_get')
+        assert not values(samples, 'couchbase_bucket_stats_hit_ratio')
+        errors = values(samples, 'couchbase_scrape_errors_total')
+        assert sorted(dict(labels)['endpoint'] for labels, count in errors.items() if count) == [
+            '/pools/default/buckets/bucket%d/nodes/%s:%d/stats' % ((index,) + addresses[2]) for index in range(2)]
+    finally:
+        for server in servers[:2]:
+            server.shutdown()
+            server.server_close()
+
+def test_group_interval_replaces_empty_groups(payloads):
+    payloads = dict(payloads)
+    xdcr = 'couchbase_bucket_xdcr_stats_percent_completeness'
+    collector = fixture_collector(payloads, group_intervals={'cluster': 600})
+    assert len(values(scrape(collector), xdcr)) == 4 * 2
+    paths = [path for path in payloads if '/@xdcr-' in path]
+    documents = dict((path, payloads.pop(path)) for path in paths)
+    # Failed requests serve the last result
+    assert len(values(scrape(collector), xdcr)) == 4 * 2
+    payloads.update((path, {'op': {'samples': {}}}) for path in paths)
+    # Every replication removed, the empty result replaces the cache
+    assert not values(scrape(collector), xdcr)
+    payloads.update(documents)
+    assert len(values(scrape(collector), xdcr)) == 4 * 2
+
+"""
+get_metrics broken in one of the ways a catalogue can fail to compile
+"""
+def broken_metrics(kind):
+    metrics = get_metrics()
+    stat = metrics['buckets']['bucket_stats'][0]
+    if kind == 'node_aggregation':
+        stat['node_aggregation'] = 'median'
+    elif kind == 'group':
+        metrics['indexes'] = {'url': '/indexStatus', 'metrics': []}
+    elif kind == 'url':
+        del metrics['nodes']['url']
+    else:
+        del stat[kind]
+    return metrics
+
+@pytest.mark.parametrize('kind', ['node_aggregation', 'group', 'url', 'suffix', 'labels'])
+def test_catalogue_that_does_not_compile(kind, tmp_path):
+    path = str(tmp_path / 'metrics.json')
+    with open(path, 'w') as f:
+        json.dump({'metrics': broken_metrics(kind)}, f)
+    with pytest.raises(ValueError):
+        load_catalogue(path)
+
+def test_reload_keeps_catalogue_that_does_not_compile(payloads, tmp_path, capsys):
+    collector = fixture_collector(payloads)
+    before = scrape(collector)
+    path = str(tmp_path / 'metrics.json')
+    with open(path, 'w') as f:
+        json.dump({'metrics': broken_metrics('node_aggregation'), 'exclude': {'buckets': ['bucket1']}}, f)
+    reload_catalogue(path, [collector])
+    assert 'keeping the current one' in capsys.readouterr().out
+    assert collector.pending_catalogue is None
+    assert scrape(collector) == before
+    # Applied directly, nothing is swapped in before it compiles
+    metrics, bucket_patterns = collector.metrics, collector.bucket_patterns
+    with pytest.raises(ValueError):
+        collector._apply_catalogue(broken_metrics('node_aggregation'), (('bucket0',), ()))
+    assert (collector.metrics, collector.bucket_patterns) == (metrics, bucket_patterns)
+    assert scrape(collector) == before
+
+def test_startup_rejects_catalogue_that_does_not_compile(tmp_path):
+    path = str(tmp_path / 'metrics.json')
+    with open(path, 'w') as f:
+        json.dump({'metrics': broken_metrics('node_aggregation')}, f)
+    result = subprocess.run([sys.executable, 'couchbase_exporter.py', '-c', 'http://127.0.0.1:1', '-p', str(free_port()), '--metrics-config', path],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=60)
+    assert result.returncode == 1
+    assert 'Failed to load metric catalogue' in result.stdout and 'median' in result.stdout
+    assert 'Traceback' not in result.stderr